@@ -0,0 +1,165 @@
+#! /usr/bin/env python
+# Encoding: UTF-8
+
+"""Running many battles in parallel
+
+Battles are given as (battle_id, description) pairs, where the description
+is a dict for Field.load. Each battle is run to the end and reduced to an
+outcome dict:
+- battle_id
+- winner: the number of the winning side, or None for a draw or error
+- ended: true if the battle ended
+- turns: the number of turns played
+- duration: wall-clock time in seconds
+- error: None, or the traceback of an exception raised by the battle
+
+Monsters, moves etc. are loaded by a given loader (by default, the dummy
+loader from regeneration.battle.example), and trainers by a trainer loader
+(see Field.load).
+"""
+
+import os
+import sys
+import copy
+import time
+import hashlib
+import traceback
+import multiprocessing
+
+import yaml
+
+from regeneration.battle import example
+from regeneration.battle.field import Field
+from regeneration.battle.trainer import Trainer
+from regeneration.battle import messages
+
+__copyright__ = 'Copyright 2011, Petr Viktorin'
+__license__ = 'MIT'
+__email__ = 'encukou@gmail.com'
+
+def derive_seed(base_seed, battle_id, purpose):
+    """Return a seed that depends only on the arguments
+    """
+    digest = hashlib.sha1(repr((base_seed, battle_id, purpose))).hexdigest()
+    return int(digest[:16], 16)
+
+def seed_description(description, battle_id, base_seed=0, override=False):
+    """Return a copy of a battle description with all random seeds filled in
+
+    Seeds already in the description are kept, unless override is true.
+    The battle and each trainer without a seed get one derived from
+    base_seed and the battle_id, so re-running a batch reproduces every
+    battle.
+    """
+    description = copy.deepcopy(description)
+    if override or 'seed' not in description:
+        description['seed'] = derive_seed(base_seed, battle_id, 'field')
+    for trainer_id, trainer in description['trainers'].items():
+        if override or 'seed' not in trainer:
+            trainer['seed'] = derive_seed(base_seed, battle_id,
+                    ('trainer', trainer_id))
+    return description
+
+def import_object(name):
+    """Return an object given by a 'module:attribute' name
+    """
+    module_name, sep, attribute = name.partition(':')
+    if not sep:
+        raise ValueError("Expected 'module:attribute', got %r" % name)
+    module = __import__(module_name, fromlist=[attribute])
+    return getattr(module, attribute)
+
+def run_battle(battle_id, description, base_seed=0, observers=(),
+        loader=None, trainer_loader=None):
+    """Run one battle and return its outcome (see the module docstring)
+
+    The observers are added to the field before the battle starts.
+    Exceptions raised by the battle are recorded in the outcome.
+    loader defaults to the example loader, and trainer_loader to
+    Trainer.load.
+    """
+    if loader is None:
+        loader = example.loader
+    if trainer_loader is None:
+        trainer_loader = Trainer.load
+    outcome = dict(battle_id=battle_id, winner=None, ended=False,
+            turns=0, duration=0.0, error=None)
+    start = time.time()
+    field = None
+    try:
+        description = seed_description(description, battle_id, base_seed)
+        field = Field.load(description, loader,
+                trainer_loader=trainer_loader)
+        for observer in observers:
+            field.add_observer(observer)
+
+        def battle_ended(message):
+            outcome['winner'] = message.side
+
+        field.add_observer(battle_ended, messages.BattleEnd)
+        field.run()
+    except Exception:
+        outcome['error'] = traceback.format_exc()
+    outcome['duration'] = time.time() - start
+    if field is not None:
+        outcome['ended'] = field.ended
+        outcome['turns'] = field.turn_number
+    return outcome
+
+def _run_battle_args(args):
+    return run_battle(*args)
+
+def run_batch(battles, processes=None, base_seed=0, chunksize=1,
+        loader=None, trainer_loader=None):
+    """Run battles, yielding outcomes in the order the battles finish
+
+    battles is an iterable of (battle_id, description) pairs.
+    processes is the number of worker processes (default: one per CPU);
+    if it's 1, battles are run in the current process, in order.
+    loader and trainer_loader are passed to run_battle. With worker
+    processes, they must be picklable: for example, module-level objects
+    and functions (see import_object).
+    """
+    arguments = ((battle_id, description, base_seed, (), loader,
+                trainer_loader)
+            for battle_id, description in battles)
+    if processes == 1:
+        for args in arguments:
+            yield _run_battle_args(args)
+        return
+    pool = multiprocessing.Pool(processes)
+    try:
+        for outcome in pool.imap_unordered(_run_battle_args, arguments,
+                chunksize):
+            yield outcome
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def iter_descriptions(path):
+    """Yield (battle_id, description) pairs from a directory or a YAML file
+
+    A directory yields each *.yaml file in it, with the file name as the id.
+    A file (or '-' for standard input) may contain several YAML documents,
+    which are identified by their index.
+    """
+    if os.path.isdir(path):
+        for filename in sorted(os.listdir(path)):
+            if filename.endswith('.yaml'):
+                with open(os.path.join(path, filename)) as file:
+                    yield filename, yaml.safe_load(file)
+    elif path == '-':
+        for item in _iter_documents(sys.stdin):
+            yield item
+    else:
+        with open(path) as file:
+            for item in _iter_documents(file):
+                yield item
+
+def _iter_documents(file):
+    for index, description in enumerate(yaml.safe_load_all(file)):
+        if description is not None:
+            yield index, description
@@ -60,6 +60,10 @@ class Battler(EffectSubject):
     def fainted(self):
         return self.hp <= 0
 
+    @property
+    def state_id(self):
+        return self.monster.state_id
+
     @property
     def is_active_subject(self):
         return not self.fainted
@@ -74,7 +78,12 @@ class Battler(EffectSubject):
 
     @status.setter
     def status(self, value):
+        field = self.field
+        field.record_setattr(self.monster, 'status')
+        field.remove_state_feature('status', self.state_id,
+                self.monster.status)
         self.monster.status = value
+        field.add_state_feature('status', self.state_id, value)
 
     @property
     def hp(self):
@@ -82,7 +91,15 @@ class Battler(EffectSubject):
 
     @hp.setter
     def hp(self, value):
+        was_fainted = self.fainted
+        field = self.field
+        field.record_setattr(self.monster, 'hp')
+        field.remove_state_feature('hp', self.state_id, self.monster.hp)
         self.monster.hp = value
+        field.add_state_feature('hp', self.state_id, value)
+        if self.fainted != was_fainted:
+            # Effects on fainted battlers are usually inactive
+            self.field.effects_changed()
 
     @property
     def tameness(self):
@@ -98,6 +115,8 @@ class Battler(EffectSubject):
 
     @item.setter
     def item(self, new_item):
+        self.field.record_setattr(self.monster, 'item')
+        self.field.record_setattr(self, 'item_effect')
         self.monster.item = new_item
         if self.item_effect:
             self.item_effect.remove()
@@ -109,6 +128,8 @@ class Battler(EffectSubject):
 
     @ability.setter
     def ability(self, new_ability):
+        self.field.record_setattr(self, '_ability')
+        self.field.record_setattr(self, 'ability_effect')
         self._ability = new_ability
         if self.ability_effect:
             self.ability_effect.remove()
@@ -125,6 +146,7 @@ class Battler(EffectSubject):
                 if battler.spot.side == self.spot.side and battler is not self]
 
     def set_move(self, i, kind):
+        self.field.record_setattr(self, 'moves')
         self.moves = list(self.moves)
         self.moves[i] = Move(kind)
 
@@ -186,6 +208,13 @@ class Battler(EffectSubject):
             result = 6
         elif result < -6:
             result = -6
+        self.field.record_setitem(self.stat_levels, stat)
+        if previous:
+            self.field.remove_state_feature('stat', self.state_id,
+                    stat.identifier, previous)
+        if result:
+            self.field.add_state_feature('stat', self.state_id,
+                    stat.identifier, result)
         self.stat_levels[stat] = result
         real_delta = result - previous
         if verbose:
@@ -0,0 +1,359 @@
+#! /usr/bin/env python
+# Encoding: UTF-8
+
+"""Compact binary battle logs
+
+A log starts with MAGIC, followed by records. Each record is a varint length
+and a payload. The payload begins with a varint: 0 introduces a message class
+(its registry name and argument names, in sorted order), any other number n
+is a message of the (n-1)th introduced class, followed by its argument values
+in that order.
+
+Values are tagged. Strings and large integers are interned: the first
+occurrence is written in full, later ones as indices into a table. Dicts are
+written as a "shape" (interned tuple of sorted keys) and the values; a dict
+identical to one written earlier is replaced by a reference to it.
+
+All tables are built up as the log is written, so a log can be decoded
+without the message classes that produced it.
+"""
+
+import struct
+from cStringIO import StringIO
+
+from regeneration.battle import messages
+
+__copyright__ = 'Copyright 2011, Petr Viktorin'
+__license__ = 'MIT'
+__email__ = 'encukou@gmail.com'
+
+MAGIC = b'RGBL\x01'
+
+(
+        NONE, FALSE, TRUE, INT, FLOAT,
+        NEW_BYTES, NEW_TEXT, NEW_BIG_INT, ATOM,
+        NEW_SHAPE, SHAPE, MEMO,
+    ) = range(12)
+
+CLASS_DEFINITION = 0
+
+# Integers outside this range are interned (these are usually ids)
+SMALL_INT_LIMIT = 2 ** 20
+
+def _write_uint(out, number):
+    while number > 0x7f:
+        out.append((number & 0x7f) | 0x80)
+        number >>= 7
+    out.append(number)
+
+def _read_uint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+def _zigzag(number):
+    if number >= 0:
+        return number << 1
+    else:
+        return ((-number) << 1) - 1
+
+def _unzigzag(number):
+    if number & 1:
+        return -((number + 1) >> 1)
+    else:
+        return number >> 1
+
+class Encoder(object):
+    """Encodes message contents into binary log records
+
+    An encoder keeps the tables of everything it has encoded so far, so the
+    records it produces must all be decoded, in order, by a single Decoder.
+    Dicts are looked up in the memo table before they are encoded, so the
+    encoded dicts must not be changed afterwards.
+    """
+    def __init__(self):
+        self.classes = {}
+        self.atoms = {}
+        self.shapes = {}
+        self.memo = {}
+        self.identities = {}
+
+    def encode(self, contents):
+        """Return record(s) for the given message contents, as a string
+        """
+        out = bytearray()
+        class_name = contents['class']
+        try:
+            number, names = self.classes[class_name]
+        except KeyError:
+            message_class = messages.message_registry[class_name]
+            names = sorted(message_class.argument_types)
+            number = len(self.classes) + 1
+            self.classes[class_name] = number, names
+            definition = bytearray()
+            definition.append(CLASS_DEFINITION)
+            self.encode_value(class_name, definition)
+            _write_uint(definition, len(names))
+            for name in names:
+                self.encode_value(name, definition)
+            _write_uint(out, len(definition))
+            out.extend(definition)
+        payload = bytearray()
+        _write_uint(payload, number)
+        encode_value = self.encode_value
+        for name in names:
+            encode_value(contents[name], payload)
+        _write_uint(out, len(payload))
+        out.extend(payload)
+        return bytes(out)
+
+    def encode_value(self, value, out):
+        value_type = type(value)
+        if value is None:
+            out.append(NONE)
+        elif value_type is bool:
+            out.append(TRUE if value else FALSE)
+        elif value_type is int or value_type is long:
+            if 0 <= value < 0x40:
+                out.append(INT)
+                out.append(value << 1)
+            elif -SMALL_INT_LIMIT < value < SMALL_INT_LIMIT:
+                out.append(INT)
+                _write_uint(out, _zigzag(value))
+            else:
+                self._encode_atom(value, out)
+        elif value_type is str or value_type is unicode:
+            self._encode_atom(value, out)
+        elif value_type is dict:
+            self._encode_dict(value, out)
+        elif value_type is float:
+            out.append(FLOAT)
+            out.extend(struct.pack('<d', value))
+        else:
+            raise TypeError("Can't encode %r" % (value, ))
+
+    def _encode_atom(self, value, out):
+        key = type(value), value
+        try:
+            index = self.atoms[key]
+        except KeyError:
+            self.atoms[key] = len(self.atoms)
+            if isinstance(value, unicode):
+                out.append(NEW_TEXT)
+                value = value.encode('utf-8')
+            elif isinstance(value, str):
+                out.append(NEW_BYTES)
+            else:
+                out.append(NEW_BIG_INT)
+                _write_uint(out, _zigzag(value))
+                return
+            _write_uint(out, len(value))
+            out.extend(value)
+        else:
+            out.append(ATOM)
+            if index < 0x80:
+                out.append(index)
+            else:
+                _write_uint(out, index)
+
+    def _memo_key(self, value):
+        """Return a hashable key that is equal for dicts encoded the same way
+        """
+        memo_key = self._memo_key
+        return frozenset([
+                (key, type(item),
+                    memo_key(item) if type(item) is dict else item)
+                for key, item in value.iteritems()])
+
+    def _encode_dict(self, value, out):
+        # Look the dict up before encoding anything: first by identity
+        # (shared contents), then by a key built from its contents
+        try:
+            index, value = self.identities[id(value)]
+        except KeyError:
+            memo_key = self._memo_key(value)
+            try:
+                index = self.memo[memo_key]
+            except KeyError:
+                # Dicts inside the body are numbered first, as in the Decoder
+                self._encode_dict_body(value, out)
+                index = self.memo[memo_key] = len(self.memo)
+                # Keep a reference to the dict so its id isn't reused
+                self.identities[id(value)] = index, value
+                return
+        out.append(MEMO)
+        _write_uint(out, index)
+
+    def _encode_dict_body(self, value, out):
+        keys = tuple(sorted(value))
+        try:
+            shape = self.shapes[keys]
+        except KeyError:
+            self.shapes[keys] = len(self.shapes)
+            out.append(NEW_SHAPE)
+            _write_uint(out, len(keys))
+            for key in keys:
+                self.encode_value(key, out)
+        else:
+            out.append(SHAPE)
+            _write_uint(out, shape)
+        encode_value = self.encode_value
+        for key in keys:
+            encode_value(value[key], out)
+
+class Decoder(object):
+    """Decodes binary log records back into message contents
+
+    Dicts that were encoded as references to earlier ones are decoded as
+    the same object, so the results should be treated as read-only (like
+    the results of Message.contents).
+    """
+    def __init__(self):
+        self.classes = []
+        self.atoms = []
+        self.shapes = []
+        self.memo = []
+
+    def decode(self, payload):
+        """Decode a record payload (without the length)
+
+        Returns the message contents, or None for class definitions.
+        """
+        data = bytearray(payload)
+        number, pos = _read_uint(data, 0)
+        if number == CLASS_DEFINITION:
+            class_name, pos = self.decode_value(data, pos)
+            count, pos = _read_uint(data, pos)
+            names = []
+            for i in range(count):
+                name, pos = self.decode_value(data, pos)
+                names.append(name)
+            self.classes.append((class_name, names))
+            return None
+        class_name, names = self.classes[number - 1]
+        contents = {'class': class_name}
+        for name in names:
+            contents[name], pos = self.decode_value(data, pos)
+        return contents
+
+    def decode_value(self, data, pos):
+        tag = data[pos]
+        pos += 1
+        if tag == ATOM:
+            index, pos = _read_uint(data, pos)
+            return self.atoms[index], pos
+        elif tag == SHAPE or tag == NEW_SHAPE:
+            return self._decode_dict(tag, data, pos)
+        elif tag == MEMO:
+            index, pos = _read_uint(data, pos)
+            return self.memo[index], pos
+        elif tag == INT:
+            number, pos = _read_uint(data, pos)
+            return _unzigzag(number), pos
+        elif tag == NONE:
+            return None, pos
+        elif tag == TRUE:
+            return True, pos
+        elif tag == FALSE:
+            return False, pos
+        elif tag == NEW_BYTES or tag == NEW_TEXT:
+            length, pos = _read_uint(data, pos)
+            value = bytes(data[pos:pos + length])
+            pos += length
+            if tag == NEW_TEXT:
+                value = value.decode('utf-8')
+            self.atoms.append(value)
+            return value, pos
+        elif tag == NEW_BIG_INT:
+            number, pos = _read_uint(data, pos)
+            value = _unzigzag(number)
+            self.atoms.append(value)
+            return value, pos
+        elif tag == FLOAT:
+            value, = struct.unpack('<d', bytes(data[pos:pos + 8]))
+            return value, pos + 8
+        else:
+            raise ValueError('Bad value tag %s at %s' % (tag, pos - 1))
+
+    def _decode_dict(self, tag, data, pos):
+        if tag == NEW_SHAPE:
+            count, pos = _read_uint(data, pos)
+            keys = []
+            for i in range(count):
+                key, pos = self.decode_value(data, pos)
+                keys.append(key)
+            self.shapes.append(keys)
+        else:
+            index, pos = _read_uint(data, pos)
+            keys = self.shapes[index]
+        value = {}
+        for key in keys:
+            value[key], pos = self.decode_value(data, pos)
+        self.memo.append(value)
+        return value, pos
+
+class BinaryLogWriter(object):
+    """A Field observer that writes messages to a binary log
+
+    Messages are written as the given trainer sees them (None means the
+    public view).
+    """
+    def __init__(self, stream, trainer=None):
+        self.stream = stream
+        self.trainer = trainer
+        self.encoder = Encoder()
+        stream.write(MAGIC)
+
+    def __call__(self, message):
+        self.write(message.contents(self.trainer))
+
+    def write(self, contents):
+        self.stream.write(self.encoder.encode(contents))
+
+def read_log(stream, chunk_size=2 ** 16):
+    """Yield message contents from a binary log in the given file object
+    """
+    magic = stream.read(len(MAGIC))
+    if magic != MAGIC:
+        raise ValueError('Not a binary battle log')
+    decoder = Decoder()
+    buffer = bytearray()
+    pos = 0
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        del buffer[:pos]
+        buffer.extend(chunk)
+        pos = 0
+        while pos < len(buffer):
+            try:
+                length, start = _read_uint(buffer, pos)
+            except IndexError:
+                break
+            end = start + length
+            if end > len(buffer):
+                break
+            contents = decoder.decode(buffer[start:end])
+            pos = end
+            if contents is not None:
+                yield contents
+    if pos < len(buffer):
+        raise ValueError('Binary battle log is truncated')
+
+def dumps(contents_list):
+    """Encode an iterable of message contents into a binary log string
+    """
+    encoder = Encoder()
+    return MAGIC + b''.join(encoder.encode(c) for c in contents_list)
+
+def loads(data):
+    """Decode a binary log string into a list of message contents
+    """
+    return list(read_log(StringIO(data)))
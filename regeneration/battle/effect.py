@@ -4,17 +4,185 @@
 from contextlib import contextmanager
 from functools import wraps, partial
 import collections
+import hashlib
 
 __copyright__ = 'Copyright 2009-2011, Petr Viktorin'
 __license__ = 'MIT'
 __email__ = 'encukou@gmail.com'
 
+class EffectList(object):
+    """An insertion-ordered collection of effects with constant-time removal
+
+    Iterating is safe while effects are added or removed: effects removed
+    during the iteration are skipped, and effects added during it are not
+    visited.
+    """
+    def __init__(self, effects=()):
+        self._nodes = {}
+        self._head = self._tail = _EffectListNode(None, 0)
+        # Serials are never reused, even when the tail is removed: an
+        # iteration only visits nodes up to the last serial it saw at start
+        self._last_serial = 0
+        for effect in effects:
+            self.append(effect)
+
+    def append(self, effect):
+        if effect in self._nodes:
+            raise ValueError('%s is already in the list' % effect)
+        tail = self._tail
+        self._last_serial += 1
+        node = _EffectListNode(effect, self._last_serial)
+        node.prev = tail
+        tail.next = node
+        self._tail = self._nodes[effect] = node
+
+    def remove(self, effect):
+        """Remove an effect; return its node, which can be given to reinsert
+        """
+        node = self._nodes.pop(effect)
+        # The removed node keeps its next pointer, so iterations that are
+        # currently at it can continue
+        node.effect = None
+        node.prev.next = node.next
+        if node.next is None:
+            self._tail = node.prev
+        else:
+            node.next.prev = node.prev
+        return node
+
+    def reinsert(self, effect, node):
+        """Undo remove(), putting the effect back where it was
+
+        Only valid if the list is in the same state as right after the
+        removal (as when undoing changes in reverse order).
+        """
+        node.effect = effect
+        node.prev.next = node
+        if node.next is None:
+            self._tail = node
+        else:
+            node.next.prev = node
+        self._nodes[effect] = node
+
+    def __contains__(self, effect):
+        return effect in self._nodes
+
+    def __iter__(self):
+        last_serial = self._tail.serial
+        node = self._head.next
+        while node is not None and node.serial <= last_serial:
+            if node.effect is not None:
+                yield node.effect
+            node = node.next
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __repr__(self):
+        return '<EffectList %s>' % list(self)
+
+class _EffectListNode(object):
+    __slots__ = 'effect serial prev next'.split()
+
+    def __init__(self, effect, serial):
+        self.effect = effect
+        self.serial = serial
+        self.prev = self.next = None
+
+_missing = object()
+
+STATE_HASH_MASK = 2 ** 64 - 1
+
+_state_hash_keys = {}
+
+def state_hash_key(feature):
+    """Return a pseudo-random 64-bit key for a feature of the battle state
+
+    Features are tuples of strings, numbers and None. The keys don't depend
+    on the process, so hashes can be compared between processes.
+    Text is hashed as UTF-8, so byte and unicode strings that compare equal
+    get the same key.
+    """
+    try:
+        return _state_hash_keys[feature]
+    except KeyError:
+        digest = hashlib.md5(repr(_encode_feature(feature))).hexdigest()
+        key = _state_hash_keys[feature] = int(digest[:16], 16)
+        return key
+
+def _encode_feature(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    elif isinstance(value, tuple):
+        return tuple(_encode_feature(item) for item in value)
+    else:
+        return value
+
+def _restore_attribute(obj, name, value):
+    if value is _missing:
+        vars(obj).pop(name, None)
+    else:
+        vars(obj)[name] = value
+
+def _restore_item(dct, key, value):
+    if value is _missing:
+        dct.pop(key, None)
+    else:
+        dct[key] = value
+
+_chain_code = {}
+
+def _get_chain_code(length):
+    """Return compiled code defining a chain dispatcher of the given length
+
+    The code only depends on the number of methods, so it's compiled once
+    for each length and cached.
+    """
+    try:
+        return _chain_code[length]
+    except KeyError:
+        pass
+    lines = ['def dispatch(object, value, *args):']
+    for index in range(length):
+        if index:
+            lines.append('    if field._generation != generation:')
+            lines.append('        return resume(%s, object, value, args)'
+                    % index)
+        lines.append('    value = method_%s(object, value, *args)' % index)
+    lines.append('    return value')
+    code = _chain_code[length] = compile('\n'.join(lines),
+            '<chain dispatcher>', 'exec')
+    return code
+
 class EffectSubject(object):
     """Something that can have Effects on it, e.g. Field, Side, Battler
     """
+    # On the field, the list of undo operations, or None if not journaling
+    # (see Field.mark)
+    journal = None
+
+    # On the field, the sum of keys of the battle state's features, modulo
+    # 2**64 (see Field.state_features)
+    state_hash = 0
+
+    # Identifies the subject in state features
+    state_id = None
+
+    # False for battlers that were withdrawn: their effects are no longer
+    # part of the battle state (see Field.state_features)
+    in_state = True
+
     def __init__(self, field):
-        self.effects = []
+        self.effects = EffectList()
+        self._effects_by_class = {}
         self.field = field
+        self._dispatch_cache = {}
+        self._active_effects = None
+        self._active_effect_set = None
+        self._generation = 0
+        self._callback_counts = collections.Counter()
+        self._disablers = []
+        self._active_disablers = None
 
     subsubjects = ()
     is_active_subject = True
@@ -27,9 +195,16 @@ class EffectSubject(object):
 
         If message_class is given, the corresponding message is sent out if
         the effect is successfully applied, before triggering other effects.
+
+        If the effect has a unique_class, and this subject already has an
+        active effect of that class, the effect is not applied.
         """
         if not effect:
             return None
+        if effect.unique_class and self.get_effect(effect.unique_class):
+            return None
+        if self.field.journal is not None:
+            previous_state = dict(vars(effect))
         effect.subject = self
         effect.field = self.field
         effect.inducer = inducer
@@ -38,7 +213,20 @@ class EffectSubject(object):
             return None
         if Effect.block_application(effect):
             return None
-        self.effects.append(effect)
+        instance_callbacks = effect.declared_callbacks.intersection(
+                vars(effect))
+        if instance_callbacks:
+            effect.implemented_callbacks = (
+                    effect.implemented_callbacks | instance_callbacks)
+        if 'disable_callback' in vars(effect):
+            effect.disables_callbacks = True
+        self.add_effect(effect)
+        self.field.register_effect(effect)
+        if self.field.journal is not None:
+            self.field.record(self._unapply_effect, effect, previous_state)
+        if self.in_state:
+            self.field.add_state_feature(*effect.state_feature())
+        self.field.effects_changed()
         if message_class:
             self.field.message(message_class, **message_args)
         Effect.effect_applied(effect)
@@ -56,6 +244,47 @@ class EffectSubject(object):
         return self.apply_effect(effect, inducer=self,
                 message_class=message_class, **message_args)
 
+    def add_effect(self, effect):
+        """Add an effect to this subject's effect lists
+
+        Effects are kept in self.effects, and also in a list for each class
+        in the effect's MRO, so that get_effects need not scan all of them.
+        Use apply_effect to actually apply an effect.
+        """
+        self.effects.append(effect)
+        by_class = self._effects_by_class
+        for cls in type(effect).__mro__:
+            try:
+                by_class[cls].append(effect)
+            except KeyError:
+                by_class[cls] = EffectList([effect])
+
+    def discard_effect(self, effect):
+        """Remove an effect from this subject's effect lists
+
+        This is the reverse of add_effect. Use Effect.remove to actually
+        remove an effect.
+        Returns a token for undiscard_effect.
+        """
+        nodes = [(self.effects, self.effects.remove(effect))]
+        by_class = self._effects_by_class
+        for cls in type(effect).__mro__:
+            effect_list = by_class[cls]
+            nodes.append((effect_list, effect_list.remove(effect)))
+        return nodes
+
+    def undiscard_effect(self, effect, nodes):
+        """Undo discard_effect, keeping the effect's original position
+        """
+        for effect_list, node in reversed(nodes):
+            effect_list.reinsert(effect, node)
+
+    def _unapply_effect(self, effect, previous_state):
+        self.field.unregister_effect(effect)
+        self.discard_effect(effect)
+        vars(effect).clear()
+        vars(effect).update(previous_state)
+
     def get_effects(self, effect_class=None):
         """Yield all effects of the given class.
 
@@ -63,9 +292,14 @@ class EffectSubject(object):
         isinstance().
         """
         if effect_class is None:
-            effect_class = object
-        for effect in self.effects:
-            if isinstance(effect, effect_class) and effect.active:
+            effects = self.effects
+        elif isinstance(effect_class, type):
+            effects = self._effects_by_class.get(effect_class, ())
+        else:
+            effects = (effect for effect in self.effects
+                    if isinstance(effect, effect_class))
+        for effect in effects:
+            if effect.active:
                 yield effect
 
     def get_effect(self, effect_class=None):
@@ -84,48 +318,229 @@ class EffectSubject(object):
 
     @property
     def active_effects(self):
-        for effect in self.effects[:]:
+        """The active effects on this subject and its subsubjects
+
+        For the field, this is a tuple that is cached until effects_changed()
+        is called. For other subjects, it is an iterator.
+        """
+        if self.field is self:
+            if self._active_effects is None:
+                self._active_effects = tuple(self._iter_active_effects())
+            return self._active_effects
+        else:
+            return self._iter_active_effects()
+
+    def _iter_active_effects(self):
+        for effect in self.effects:
             if effect.active:
                 yield effect
         for subsubject in self.subsubjects:
-            for effect in subsubject.active_effects:
+            for effect in subsubject._iter_active_effects():
                 if (subsubject.is_active_subject or
                         effect.active_on_fainted_subject):
                     yield effect
 
-    def get_effect_methods(self, cls, attr, object, arguments):
-        """Yields an attribute for all active effects of a given class.
+    def _get_active_effect_set(self):
+        if self._active_effect_set is None:
+            self._active_effect_set = frozenset(self.active_effects)
+        return self._active_effect_set
+
+    def effects_changed(self):
+        """Invalidate the cached active effects and callback dispatch info
+
+        Called on the field whenever the set of active effects might have
+        changed: when effects are applied, removed, moved or disabled, and
+        when battlers are switched or faint.
+        """
+        self._dispatch_cache.clear()
+        self._active_effects = None
+        self._active_effect_set = None
+        self._active_disablers = None
+        self._generation += 1
+
+    def add_state_feature(self, *feature):
+        """Add a feature's key to the state hash
+        """
+        self.state_hash = (self.state_hash + state_hash_key(feature)
+                ) & STATE_HASH_MASK
+
+    def remove_state_feature(self, *feature):
+        """Remove a feature's key from the state hash
+        """
+        self.state_hash = (self.state_hash - state_hash_key(feature)
+                ) & STATE_HASH_MASK
+
+    def record(self, undo, *args):
+        """Record a function to undo a change, if journaling (see Field.mark)
+        """
+        if self.journal is not None:
+            self.journal.append((undo, args))
+
+    def record_setattr(self, obj, name):
+        """Record an attribute's value so that a rollback can restore it
+
+        Call before changing the attribute.
+        """
+        if self.journal is not None:
+            self.journal.append((_restore_attribute,
+                    (obj, name, vars(obj).get(name, _missing))))
+
+    def record_setitem(self, dct, key):
+        """Record a dict item so that a rollback can restore it
+
+        Call before changing or deleting the item.
+        """
+        if self.journal is not None:
+            self.journal.append((_restore_item,
+                    (dct, key, dct.get(key, _missing))))
+
+    def register_effect(self, effect):
+        """Start tracking an effect applied anywhere on this field
+
+        The field counts the effects implementing each callback: callbacks
+        that no effect implements return their default value without looking
+        at the effects at all.
+        It also keeps a list of effects that can disable others' callbacks.
+        """
+        counts = self._callback_counts
+        for name in effect.implemented_callbacks:
+            counts[name] += 1
+        if effect.disables_callbacks:
+            self._disablers.append(effect)
+
+    def unregister_effect(self, effect):
+        """Stop tracking an effect; the reverse of register_effect()
         """
+        counts = self._callback_counts
+        for name in effect.implemented_callbacks:
+            counts[name] -= 1
+        if effect.disables_callbacks:
+            self._disablers.remove(effect)
+
+    def get_effect_methods(self, cls, attr, object, arguments,
+            with_effects=False):
+        """Yields an attribute for all active effects of a given class.
+
+        The sorted list of (orderkey, effect, method) entries is cached per
+        (cls, attr) until effects_changed() is called.
+
+        Only effects whose class implements attr (see implemented_callbacks)
+        are considered.
+        If with_effects is true, (effect, method) pairs are yielded instead.
+        """
+        entries = self._get_dispatch_entries(cls, attr)
+        return self._iterate_dispatch_entries(entries, arguments,
+                with_effects=with_effects)
+
+    def get_chain_dispatcher(self, cls, attr):
+        """Return a function that runs a chain callback on active effects
+
+        The function is generated with the effects' methods baked in, and
+        cached until effects_changed() is called. It is called with the
+        chain callback's arguments (object, value, *args).
+
+        Returns None if the dispatch can't be compiled (because some effects
+        may disable callbacks); use get_effect_methods in that case.
+        """
+        key = cls, attr, chain
+        try:
+            return self._dispatch_cache[key]
+        except KeyError:
+            if self._get_active_disablers():
+                dispatcher = None
+            else:
+                dispatcher = self._compile_chain(
+                        self._get_dispatch_entries(cls, attr))
+            self._dispatch_cache[key] = dispatcher
+            return dispatcher
+
+    def _compile_chain(self, entries):
+        if not entries:
+            return lambda object, value, *args: value
+
+        def resume(index, object, value, args):
+            # The effects changed under our hands; continue generically
+            methods = self._iterate_dispatch_entries(entries[index:], args,
+                    self._get_active_effect_set())
+            for method in methods:
+                value = method(object, value, *args)
+            return value
+
+        namespace = dict(field=self, generation=self._generation,
+                resume=resume)
+        for index, (orderkey, effect, method) in enumerate(entries):
+            namespace['method_%s' % index] = method
+        exec _get_chain_code(len(entries)) in namespace
+        return namespace['dispatch']
+
+    def _get_dispatch_entries(self, cls, attr):
+        key = cls, attr
+        try:
+            return self._dispatch_cache[key]
+        except KeyError:
+            entries = self._collect_dispatch_entries(cls, attr)
+            self._dispatch_cache[key] = entries
+            return entries
+
+    def _collect_dispatch_entries(self, cls, attr):
         def generator():
             for effect in self.active_effects:
+                if attr not in effect.implemented_callbacks:
+                    continue
                 if cls is None or isinstance(effect, cls):
+                    callback = getattr(effect, attr)
                     try:
-                        callback = getattr(effect, attr)
+                        orderkey = callback.orderkey
                     except AttributeError:
-                        pass
+                        yield None, effect, callback
                     else:
-                        try:
-                            orderkey = callback.orderkey
-                        except AttributeError:
-                            yield None, effect, callback
-                        else:
-                            if callable(orderkey):
-                                orderkey = orderkey(effect)
-                                if isinstance(orderkey, collections.Iterator):
-                                    for key in orderkey:
-                                        yield key, effect, callback
-                                    continue
-                            yield orderkey, effect, callback
-        return (v for k, e, v in sorted(generator())
-                if e in self.active_effects and
-                        not any(ef.disable_callback(e, v.__name__, arguments)
-                                for ef in self.active_effects))
-
-def return_list(func):
-    @wraps(func)
-    def wrapped(*args, **kwargs):
-        return list(func(*args, **kwargs))
-    return wrapped
+                        if callable(orderkey):
+                            orderkey = orderkey(effect)
+                            if isinstance(orderkey, collections.Iterator):
+                                for key in orderkey:
+                                    yield key, effect, callback
+                                continue
+                        yield orderkey, effect, callback
+        return tuple(sorted(generator(), key=_entry_rank))
+
+    def _get_active_disablers(self):
+        if self._active_disablers is None:
+            if self._disablers:
+                active_effects = self._get_active_effect_set()
+                self._active_disablers = tuple(ef for ef in self._disablers
+                        if ef in active_effects)
+            else:
+                self._active_disablers = ()
+        return self._active_disablers
+
+    def _iterate_dispatch_entries(self, entries, arguments,
+            active_effects=None, with_effects=False):
+        # If the effects change while the callbacks run (e.g. one removes
+        # another), the entries that are no longer active must be skipped.
+        # The active_effects set is only needed when resuming a dispatch.
+        generation = self._generation
+        disablers = self._get_active_disablers()
+        for orderkey, effect, method in entries:
+            if generation != self._generation:
+                generation = self._generation
+                active_effects = self._get_active_effect_set()
+                disablers = self._get_active_disablers()
+            if active_effects is not None and effect not in active_effects:
+                continue
+            if disablers and any(
+                    ef.disable_callback(effect, method.__name__, arguments)
+                    for ef in disablers):
+                continue
+            if with_effects:
+                yield effect, method
+            else:
+                yield method
+
+def _entry_rank(entry):
+    # Sort by the integer rank of OrderKeys, avoiding calls to OrderKey's
+    # comparison methods; other kinds of keys are compared directly
+    orderkey = entry[0]
+    return getattr(orderkey, 'rank', orderkey)
 
 class callback(object):
     """A magic callback method
@@ -139,27 +554,40 @@ class callback(object):
     Note that the decorated (base class) method itself will only be present on
     the class (not on instances), and thus will not be called. This means that
     the body of the decorated function is ignored.
+
+    All callbacks are listed in callback.instances (used for profiling).
     """
+    instances = []
+
     def __init__(self, func, orderkey=None):
         self.func = func
         self.name = func.__name__
+        self.bound = {}
+        callback.instances.append(self)
 
     def __get__(self, instance, owner):
         if instance:
             raise AttributeError(self.name)
-        else:
-            return wraps(self.func)(partial(self.run_all, owner))
-
-    def get_effect_methods(self, owner, object, arguments):
+        try:
+            return self.bound[owner]
+        except KeyError:
+            bound = wraps(self.func)(partial(self.run_all, owner))
+            self.bound[owner] = bound
+            return bound
+
+    def get_effect_methods(self, owner, object, arguments,
+            with_effects=False):
         return object.field.get_effect_methods(owner, self.name, object,
-                arguments)
+                arguments, with_effects)
 
-    @return_list
     def run_all(self, owner, object, *args):
-        for method in self.get_effect_methods(owner, object, args):
-            value = method(object, *args)
-            if value:
-                yield value
+        results = []
+        if object.field._callback_counts[self.name]:
+            for method in self.get_effect_methods(owner, object, args):
+                value = method(object, *args)
+                if value:
+                    results.append(value)
+        return results
 
 class chain(callback):
     """A yet more magic callback, which chains its second argument
@@ -172,9 +600,23 @@ class chain(callback):
     Note that the decorated (base class) method itself will only be present on
     the class (not on instances), and thus will not be called. This means that
     the body of the decorated function is ignored.
+
+    Chains are run using a function generated by the field (see
+    EffectSubject.get_chain_dispatcher). The run_generic method runs them
+    using get_effect_methods instead.
     """
 
     def run_all(self, owner, object, value, *args):
+        field = object.field
+        if not field._callback_counts[self.name]:
+            return value
+        dispatcher = field.get_chain_dispatcher(owner, self.name)
+        if dispatcher is None:
+            return self.run_generic(owner, object, value, *args)
+        else:
+            return dispatcher(object, value, *args)
+
+    def run_generic(self, owner, object, value, *args):
         for method in self.get_effect_methods(owner, object, args):
             value = method(object, value, *args)
         return value
@@ -185,10 +627,65 @@ class callback_any(callback):
     If no true value is found, returns None.
     """
     def run_all(self, owner, object, *args):
-        for method in self.get_effect_methods(owner, object, args):
-            value = method(object, *args)
-            if value:
-                return value
+        if object.field._callback_counts[self.name]:
+            for method in self.get_effect_methods(owner, object, args):
+                value = method(object, *args)
+                if value:
+                    return value
+
+class _EffectMetaclass(type):
+    """Records which callbacks an Effect class implements
+
+    Callbacks are declared using the callback, chain and callback_any
+    decorators; a subclass implements one by defining an attribute of the
+    same name. The names of implemented callbacks are stored in the class's
+    implemented_callbacks attribute, so that dispatch does not need to probe
+    effect instances. Callbacks set directly on an instance are added when
+    the effect is applied.
+
+    Similarly, disables_callbacks is true for classes that override
+    Effect.disable_callback.
+
+    Since these are only computed when the class is created, setting or
+    deleting a callback (or disable_callback) on an existing class raises
+    TypeError.
+    """
+    def __init__(cls, name, bases, dct):
+        super(_EffectMetaclass, cls).__init__(name, bases, dct)
+        declared = set()
+        for superclass in cls.__mro__:
+            for attr, value in vars(superclass).items():
+                if isinstance(value, callback):
+                    declared.add(attr)
+        implemented = set()
+        for attr in declared:
+            for superclass in cls.__mro__:
+                if attr in vars(superclass):
+                    if not isinstance(vars(superclass)[attr], callback):
+                        implemented.add(attr)
+                    break
+        cls.declared_callbacks = frozenset(declared)
+        cls.implemented_callbacks = frozenset(implemented)
+        cls.disables_callbacks = not getattr(cls.disable_callback,
+                'is_default', False)
+
+    def __setattr__(cls, attr, value):
+        cls._check_callback_change(attr)
+        if isinstance(value, callback):
+            raise TypeError("Can't declare callback %s on existing class %s"
+                    % (attr, cls.__name__))
+        super(_EffectMetaclass, cls).__setattr__(attr, value)
+
+    def __delattr__(cls, attr):
+        cls._check_callback_change(attr)
+        super(_EffectMetaclass, cls).__delattr__(attr)
+
+    def _check_callback_change(cls, attr):
+        if (attr in getattr(cls, 'declared_callbacks', ()) or
+                attr == 'disable_callback'):
+            raise TypeError("Can't change callback %s of existing class %s; "
+                    "define it in the class body or in a subclass" % (
+                        attr, cls.__name__))
 
 class Effect(object):
     """An effect is something that interacts with moves, other effects, and
@@ -205,9 +702,18 @@ class Effect(object):
 
     Always apply effects using effectSubject methods (give_effect etc.).
 
+    If unique_class is set, the effect is not applied to a subject that
+    already has an active effect of that class.
+
     When used as a context manager, an Effect will remove itself when exiting
     the context.
+
+    Callbacks are implemented by defining them in the class body. They can
+    not be added to (or removed from) a class after it is created. An
+    instance may get its own callbacks, but only before it is applied.
     """
+    __metaclass__ = _EffectMetaclass
+
     unique_class = None
 
     active = False
@@ -240,22 +746,45 @@ class Effect(object):
     def reparent(self, new_subject):
         """Move the effect onto another subject.
         """
-        self.subject.effects = [
-                e for e
-                in self.subject.effects
-                if e is not self
-            ]
+        old_subject = self.subject
+        if old_subject.in_state:
+            self.field.remove_state_feature(*self.state_feature())
+        nodes = old_subject.discard_effect(self)
         self.subject = new_subject
-        self.subject.effects.append(self)
+        self.subject.add_effect(self)
+        if new_subject.in_state:
+            self.field.add_state_feature(*self.state_feature())
+        self.field.record(self._unreparent, old_subject, nodes)
+        self.field.effects_changed()
+
+    def _unreparent(self, old_subject, nodes):
+        self.subject.discard_effect(self)
+        self.subject = old_subject
+        old_subject.undiscard_effect(self, nodes)
 
     def remove(self):
         Effect.effect_removed(self)
+        field = self.field
+        if field.journal is not None:
+            previous_state = dict(vars(self))
         self.active = False
-        self.subject.effects = [
-                e for e
-                in self.subject.effects
-                if e is not self
-            ]
+        nodes = None
+        if self in self.subject.effects:
+            if self.subject.in_state:
+                # (Withdrawing already removed the feature otherwise)
+                field.remove_state_feature(*self.state_feature())
+            field.unregister_effect(self)
+            nodes = self.subject.discard_effect(self)
+        if field.journal is not None:
+            field.record(self._unremove, previous_state, nodes)
+        field.effects_changed()
+
+    def _unremove(self, previous_state, nodes):
+        vars(self).clear()
+        vars(self).update(previous_state)
+        if nodes:
+            self.subject.undiscard_effect(self, nodes)
+            self.field.register_effect(self)
 
     @contextmanager
     def disabled(self):
@@ -263,8 +792,21 @@ class Effect(object):
         """
         previous = self.active
         self.active = False
+        self.field.effects_changed()
         yield
         self.active = previous
+        self.field.effects_changed()
+
+    def state_feature(self):
+        """Return the feature identifying this effect in the state hash
+
+        By default, that's the subject and the effect's class. Effects with
+        state that matters for the battle can include it, but they must then
+        remove and re-add the feature (see EffectSubject.add_state_feature)
+        whenever that state changes.
+        """
+        cls = type(self)
+        return 'effect', self.subject.state_id, cls.__module__, cls.__name__
 
     def __str__(self):
         return self.__class__.__name__
@@ -274,8 +816,11 @@ class Effect(object):
 
     def disable_callback(self, effect, callback_name, arguments):
         """Return true to disable another effect's callback.
+
+        Only effects that override this method are asked.
         """
         return False
+    disable_callback.is_default = True
 
     # Notifications
 
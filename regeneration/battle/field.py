@@ -1,38 +1,92 @@
 #! /usr/bin/env python
 # Encoding: UTF-8
 
+import copy
 import random
+from contextlib import contextmanager
 from functools import partial
 from fractions import Fraction
 
 from regeneration.battle import messages
-from regeneration.battle.effect import Effect, EffectSubject
+from regeneration.battle.effect import Effect, EffectSubject, EffectList
+from regeneration.battle.effect import state_hash_key, STATE_HASH_MASK
 from regeneration.battle.battler import Battler
 from regeneration.battle.command import CommandRequest, MoveCommand
 from regeneration.battle.moveeffect import MoveEffect
 from regeneration.battle.trainer import Trainer
 from regeneration.battle.helper_effects import default_effect_classes
+from regeneration.battle import orderkey
 
 __copyright__ = 'Copyright 2009-2011, Petr Viktorin'
 __license__ = 'MIT'
 __email__ = 'encukou@gmail.com'
 
+# The order keys created at import time (such as the damage modifiers in
+# helper_effects) exist now, so they can get their final ranks
+orderkey.freeze()
+
 class MessageSender(object):
+    """Constructs messages and sends them to the field's observers
+
+    Use either field.message(MessageClass, **arguments), or
+    field.message.MessageClass(**arguments) for classes (or factory functions
+    like effectivity) in the field's message module.
+
+    If no observer is interested in the message, it is not constructed at
+    all (see Field.is_observed). The argument names are still checked against
+    the message class, so mistakes don't go unnoticed in unobserved battles;
+    the values are not.
+    """
     def __init__(self, field, messages):
         self.field = field
         self.messages = messages
+        self._argument_names = {}
 
     def __getattr__(self, attr):
-        return partial(self, getattr(self.messages, attr))
+        sender = partial(self, getattr(self.messages, attr))
+        # Cache the sender; __getattr__ is not called for it again
+        setattr(self, attr, sender)
+        return sender
 
     def __call__(self, cls, **kwargs):
-        self.field.send_message(cls(field=self.field, **kwargs))
+        field = self.field
+        if field.observers and field.is_observed(cls):
+            field.send_message(cls(field=field, **kwargs))
+        else:
+            self.check_arguments(cls, kwargs)
+
+    def check_arguments(self, cls, kwargs):
+        """Raise ValueError if kwargs don't fit the message class or factory
+
+        Unknown names are always an error. Missing names can only be
+        detected for classes that use Message's own __init__.
+        """
+        try:
+            allowed, required = self._argument_names[cls]
+        except KeyError:
+            message_class = getattr(cls, 'message_class', cls)
+            allowed = frozenset(message_class.argument_types) - set(['field'])
+            if (isinstance(cls, type) and
+                    cls.__init__.__func__ is
+                        messages.Message.__init__.__func__):
+                required = allowed
+            else:
+                required = frozenset()
+            self._argument_names[cls] = allowed, required
+        names = frozenset(kwargs)
+        if not allowed >= names:
+            raise ValueError("Extra keyword arguments: %s" %
+                    ', '.join(sorted(names - allowed)))
+        if not names >= required:
+            raise ValueError("Missing keyword arguments: %s" %
+                    ', '.join(sorted(required - names)))
 
 class Side(EffectSubject):
     def __init__(self, field, number, trainers):
         EffectSubject.__init__(self, field)
         self.number = number
         self.field = field
+        self.state_id = 'side', number
         try:
             trainers = iter(trainers)
         except TypeError:
@@ -65,13 +119,68 @@ class Spot(object):
     def turn_order(self):
         return self.field.turn_order.index(self)
 
+def _copy_dict(value):
+    if type(value) is dict:
+        value = dict(value)
+    else:
+        value = copy.copy(value)
+    for key, item in value.items():
+        copier = _get_copier(type(item))
+        if copier:
+            value[key] = copier(item)
+    return value
+
+_copiers = {list: list, set: set, dict: _copy_dict, EffectList: EffectList}
+
+def _get_copier(cls):
+    """Get a function to copy a mutable container (and containers in it)
+
+    Returns None for types that aren't copied.
+    """
+    try:
+        return _copiers[cls]
+    except KeyError:
+        if issubclass(cls, EffectList):
+            copier = EffectList
+        elif issubclass(cls, dict):
+            copier = _copy_dict
+        else:
+            copier = None
+        _copiers[cls] = copier
+        return copier
+
+def _copy_state(state):
+    state = dict(state)
+    for name, value in state.items():
+        copier = _get_copier(type(value))
+        if copier:
+            state[name] = copier(value)
+    return state
+
+class FieldSnapshot(object):
+    """Saved state of a battle; see Field.snapshot
+    """
+    def __init__(self, states, rand_states):
+        self.states = states
+        self.rand_states = rand_states
+
 class Field(EffectSubject):
     BattlerClass = Battler
     message_module = messages
 
     allow_run = True
 
-    state = 'new'
+    _state = 'new'
+    _turn_number = 0
+
+    state_id = 'field',
+
+    # True while exploring hypothetical turns (see simulation())
+    simulating = False
+
+    # If set, an object whose flip_coin and randint methods decide chance
+    # events instead of the random generator (see simulation())
+    chance = None
 
     def __init__(self, loader, trainers, rand=random):
         """ Make a Battlefield, pitting the given trainers against each other!
@@ -90,6 +199,8 @@ class Field(EffectSubject):
         self.sides = [Side(self, i, t) for i, t in enumerate(trainers)]
 
         self.observers = []
+        self.observer_classes = []
+        self._message_routes = {}
 
         self.struggle = self.loader.load_struggle()
 
@@ -98,8 +209,42 @@ class Field(EffectSubject):
         self.in_loop = False
         self.turn_number = 0
 
+        self.assign_state_ids()
+        self.state_hash = self.compute_state_hash()
+
     # Helpers
 
+    @property
+    def state(self):
+        return self._state
+
+    @state.setter
+    def state(self, value):
+        self.record_setattr(self, '_state')
+        self.remove_state_feature('state', self._state)
+        self._state = value
+        self.add_state_feature('state', value)
+
+    @property
+    def turn_number(self):
+        return self._turn_number
+
+    @turn_number.setter
+    def turn_number(self, value):
+        self.record_setattr(self, '_turn_number')
+        self._turn_number = value
+
+    @property
+    def monsters(self):
+        """All monsters in the trainers' teams"""
+        seen = set()
+        for spot in self.spots:
+            trainer = spot.trainer
+            if id(trainer) not in seen:
+                seen.add(id(trainer))
+                for monster in trainer.team:
+                    yield monster
+
     @property
     def spots(self):
         for side in self.sides:
@@ -144,14 +289,76 @@ class Field(EffectSubject):
 
     # Messages
 
-    def add_observer(self, observer):
+    def add_observer(self, observer, message_classes=None):
+        """Add an observer, a callable that will be called with messages
+
+        If message_classes is given, the observer only gets messages of these
+        classes (including subclasses). It may be a class, a registry name
+        (see messages.message_registry), or a sequence of these.
+        Unknown names and non-classes raise ValueError.
+        """
+        if message_classes is not None:
+            if isinstance(message_classes, (type, basestring)):
+                message_classes = [message_classes]
+            message_classes = tuple(self._get_message_class(cls)
+                    for cls in message_classes)
         self.observers.append(observer)
+        self.observer_classes.append(message_classes)
+        self._message_routes.clear()
+
+    def _get_message_class(self, cls):
+        if isinstance(cls, basestring):
+            try:
+                return self.message_module.message_registry[cls]
+            except KeyError:
+                raise ValueError('Unknown message class: %s' % cls)
+        elif isinstance(cls, type):
+            return cls
+        else:
+            raise ValueError('Not a message class: %r' % (cls, ))
 
     def remove_observer(self, observer):
-        self.observers.remove(observer)
+        index = self.observers.index(observer)
+        del self.observers[index]
+        del self.observer_classes[index]
+        self._message_routes.clear()
+
+    def get_observers(self, message_class):
+        """Return observers that want messages of the given class
+        """
+        try:
+            return self._message_routes[message_class]
+        except KeyError:
+            observers = tuple(observer for observer, classes
+                    in zip(self.observers, self.observer_classes)
+                    if classes is None or issubclass(message_class, classes))
+            self._message_routes[message_class] = observers
+            return observers
+
+    def is_observed(self, message_factory):
+        """Return true if a message made by message_factory has any observers
+
+        The factory is a message class, or a function with a message_class
+        attribute giving the base class of the messages it creates (like
+        messages.effectivity).
+        """
+        key = 'factory', message_factory
+        try:
+            return self._message_routes[key]
+        except KeyError:
+            if isinstance(message_factory, type):
+                observed = bool(self.get_observers(message_factory))
+            else:
+                base = message_factory.message_class
+                observed = any(classes is None or
+                        any(issubclass(cls, base) or issubclass(base, cls)
+                            for cls in classes)
+                        for classes in self.observer_classes)
+            self._message_routes[key] = observed
+            return observed
 
     def send_message(self, message):
-        for observer in self.observers:
+        for observer in self.get_observers(type(message)):
             observer(message)
 
     def message_values(self, trainer):
@@ -181,6 +388,219 @@ class Field(EffectSubject):
             kwargs['rand'] = random.Random(dct['seed'])
         return cls(loader, trainers, **kwargs)
 
+    # Snapshots
+
+    # Field attributes that aren't battle state, and are kept on restore
+    unsaved_attributes = ('observers', 'observer_classes', '_message_routes',
+            '_dispatch_cache', '_generation', 'journal', 'simulating',
+            'chance')
+
+    def snapshot_objects(self):
+        """Yield objects whose attributes make up the state of the battle
+
+        These are the field, sides, spots, trainers, active battlers, all
+        monsters, their moves, and all effects.
+        """
+        yield self
+        for effect in self.effects:
+            yield effect
+        for side in self.sides:
+            yield side
+            for effect in side.effects:
+                yield effect
+            for spot in side.spots:
+                yield spot
+                yield spot.trainer
+                for monster in spot.trainer.team:
+                    yield monster
+                    for move in monster.moves:
+                        yield move
+                battler = spot.battler
+                if battler:
+                    yield battler
+                    for move in battler.moves:
+                        yield move
+                    for effect in battler.effects:
+                        yield effect
+
+    def snapshot(self):
+        """Save the state of the battle, so it can be restored later
+
+        Only mutable state is copied: the attributes of objects given by
+        snapshot_objects, including containers in them (effect lists, stat
+        levels, move lists, ...), and the state of the field's and trainers'
+        random generators. Loader data and OrderKeys are shared.
+
+        The snapshot can be restored any number of times.
+        """
+        states = []
+        seen = set()
+        for obj in self.snapshot_objects():
+            if id(obj) not in seen:
+                seen.add(id(obj))
+                state = vars(obj)
+                if obj is self:
+                    state = dict((name, value) for name, value
+                            in state.items()
+                            if name not in self.unsaved_attributes)
+                states.append((obj, _copy_state(state)))
+        return FieldSnapshot(states, self._get_rand_states())
+
+    def _get_rand_states(self):
+        rand_states = []
+        seen = set()
+        for rand in [self.rand] + [spot.trainer.rand for spot in self.spots]:
+            if id(rand) not in seen:
+                seen.add(id(rand))
+                rand_states.append((rand, rand.getstate()))
+        return rand_states
+
+    def restore(self, snapshot):
+        """Return the battle to the state saved by snapshot()
+
+        Observers are not affected.
+        Restoring is not journaled, so it's not allowed while journaling (see
+        mark and stop_journal).
+        """
+        if self.journal is not None:
+            raise AssertionError('Cannot restore a snapshot while journaling')
+        kept = dict((name, vars(self)[name]) for name
+                in self.unsaved_attributes if name in vars(self))
+        for obj, state in snapshot.states:
+            attributes = vars(obj)
+            attributes.clear()
+            attributes.update(_copy_state(state))
+        vars(self).update(kept)
+        for rand, state in snapshot.rand_states:
+            rand.setstate(state)
+        self.effects_changed()
+
+    # State hash
+
+    def assign_state_ids(self):
+        """Give each monster and its moves ids for use in state features
+        """
+        trainer_numbers = {}
+        for spot in self.spots:
+            trainer_number = trainer_numbers.setdefault(id(spot.trainer),
+                    len(trainer_numbers))
+            for index, monster in enumerate(spot.trainer.team):
+                monster.state_id = 'monster', trainer_number, index
+                for move_index, move in enumerate(monster.moves):
+                    move.state_id = monster.state_id + (move_index, )
+
+    def state_features(self):
+        """Yield the features of the battle state that make up state_hash
+
+        These are the monsters' HP, status and PP, the active battlers with
+        their stat levels, the effects on the field, sides and active
+        battlers, and the field's state.
+        The hash is not computed from these each time: the methods that
+        change the state update it as they go. compute_state_hash() gives
+        the same result by going through all features.
+        """
+        yield 'state', self.state
+        subjects = [self]
+        for side in self.sides:
+            subjects.append(side)
+            for spot in side.spots:
+                battler = spot.battler
+                if battler:
+                    subjects.append(battler)
+                    yield ('spot', side.number, spot.number,
+                            battler.state_id)
+                    for stat, level in battler.stat_levels.items():
+                        if level:
+                            yield ('stat', battler.state_id,
+                                    stat.identifier, level)
+        for subject in subjects:
+            for effect in subject.effects:
+                yield effect.state_feature()
+        for monster in self.monsters:
+            yield 'hp', monster.state_id, monster.hp
+            yield 'status', monster.state_id, monster.status
+            for move in monster.moves:
+                if move.state_id is not None:
+                    yield 'pp', move.state_id, move.pp
+
+    def compute_state_hash(self):
+        """Compute the state hash from scratch
+        """
+        return sum(state_hash_key(feature) for feature
+                in self.state_features()) & STATE_HASH_MASK
+
+    # Journal
+
+    def mark(self):
+        """Start journaling changes, and return a mark for rollback()
+
+        While journaling, changes to the battle state record operations that
+        undo them: HP, status, stat levels, PP, moves, items, abilities,
+        effects being applied, removed and moved, battlers being switched,
+        pending command requests, and the state and turn number.
+        Effects that keep other state of their own should record it using
+        record_setattr or record_setitem.
+
+        The random generators' states are saved with each mark.
+        """
+        if self.journal is None:
+            self.journal = []
+        return len(self.journal), self._get_rand_states(), self.state_hash
+
+    def rollback(self, mark):
+        """Undo all changes made since mark() returned the given mark
+
+        This takes time proportional to the number of changes undone.
+        Marks made after the given one become invalid; earlier ones can still
+        be used. Messages already sent are not taken back.
+        """
+        length, rand_states, state_hash = mark
+        journal, self.journal = self.journal, None
+        try:
+            while len(journal) > length:
+                undo, args = journal.pop()
+                undo(*args)
+        finally:
+            self.journal = journal
+        for rand, state in rand_states:
+            rand.setstate(state)
+        self.state_hash = state_hash
+        self.effects_changed()
+
+    def stop_journal(self):
+        """Stop journaling and forget the recorded changes
+        """
+        self.journal = None
+
+    @contextmanager
+    def simulation(self, chance=None):
+        """Context manager for exploring hypothetical turns
+
+        Inside the block, trainers are not asked for commands: requests are
+        left pending, for the caller to select commands for. Observers get no
+        messages, and if chance is given, it decides chance events (see the
+        chance attribute).
+        When the block ends, the battle is rolled back to its state at the
+        start of the block.
+        """
+        journaling = self.journal is not None
+        mark = self.mark()
+        saved = (self.simulating, self.chance, self.observers,
+                self.observer_classes, self._message_routes)
+        self.simulating = True
+        self.chance = chance
+        self.observers = []
+        self.observer_classes = []
+        self._message_routes = {}
+        try:
+            yield
+        finally:
+            self.rollback(mark)
+            (self.simulating, self.chance, self.observers,
+                    self.observer_classes, self._message_routes) = saved
+            if not journaling:
+                self.stop_journal()
+
     # Main logic
 
     def run(self):
@@ -224,6 +644,8 @@ class Field(EffectSubject):
     def ask_for_commands(self):
         self.assert_state('waiting', 'waiting_replacements')
 
+        self.record_setattr(self, 'active_requests')
+        self.record_setattr(self, 'commands')
         self.active_requests = {}
         self.commands = {}
 
@@ -244,6 +666,9 @@ class Field(EffectSubject):
 
             self.state = 'waiting'
 
+        if self.simulating:
+            return
+
         for spot in self.spots:
             battler = spot.battler
             request = self.active_requests.get(battler)
@@ -266,12 +691,14 @@ class Field(EffectSubject):
     def command_selected(self, command, process=True):
         self.assert_state('waiting', 'waiting_replacements')
 
-        try:
-            del self.active_requests[command.request.battler]
-        except KeyError:
+        battler = command.request.battler
+        if battler not in self.active_requests:
             raise AssertionError("Not waiting for a command for that battler")
+        self.record_setitem(self.active_requests, battler)
+        del self.active_requests[battler]
 
-        self.commands[command.request.battler] = command
+        self.record_setitem(self.commands, battler)
+        self.commands[battler] = command
 
         if not self.active_requests:
             if self.state == 'waiting_replacements':
@@ -302,8 +729,10 @@ class Field(EffectSubject):
 
     def do_turn(self):
         self.turn_number += 1
+        self.record_setattr(self, 'can_save')
         self.can_save = False
         self.handle_turn()
+        self.record_setattr(self, 'can_save')
         self.can_save = True
 
     # Mechanics
@@ -363,8 +792,10 @@ class Field(EffectSubject):
         self.message.TurnStart(turn=self.turn_number)
         Effect.begin_turn(self)
 
+        self.record_setattr(self, 'turnCommands')
         self.turnCommands = commands = self.sort_commands(commands)
 
+        self.record_setattr(self, 'turn_order')
         self.turn_order = [c.request.spot for c in commands]
 
         move_effects = {}
@@ -401,6 +832,7 @@ class Field(EffectSubject):
         self.message.TurnEnd(turn=self.turn_number)
 
         # That's it for this turn!
+        self.record_setattr(self, 'turn_order')
         del self.turn_order
 
         if not self.ended:
@@ -440,11 +872,28 @@ class Field(EffectSubject):
         if not battler.fainted:
             self.message.Withdraw(battler=battler)
         Effect.withdraw(battler)
-        battler.spot.battler = None
+        spot = battler.spot
+        self.remove_state_feature('spot', spot.side.number, spot.number,
+                battler.state_id)
+        for stat, level in battler.stat_levels.items():
+            if level:
+                self.remove_state_feature('stat', battler.state_id,
+                        stat.identifier, level)
+        for effect in battler.effects:
+            self.remove_state_feature(*effect.state_feature())
+        self.record_setattr(battler, 'in_state')
+        battler.in_state = False
+        self.record_setattr(spot, 'battler')
+        spot.battler = None
+        self.effects_changed()
 
     def release_monster(self, spot, monster):
         assert spot.battler is None
+        self.record_setattr(spot, 'battler')
         spot.battler = battler = self.BattlerClass(monster, spot, self.loader)
+        self.add_state_feature('spot', spot.side.number, spot.number,
+                battler.state_id)
+        self.effects_changed()
         self.message.SendOut(battler=battler)
 
     def check_win(self):
@@ -485,10 +934,14 @@ class Field(EffectSubject):
 
     def flip_coin(self, chance, blurb):
         chance = Fraction(chance)
+        if self.chance is not None:
+            return self.chance.flip_coin(chance, blurb)
         max = chance.denominator - 1
         return self.randint(0, max, blurb) < chance.numerator
 
     def randint(self, min, max, blurb):
+        if self.chance is not None:
+            return self.chance.randint(min, max, blurb)
         return self.rand.randint(min, max)
 
     def shuffle(self, list, blurb):
@@ -0,0 +1,124 @@
+#! /usr/bin/env python
+# Encoding: UTF-8
+
+"""Battle logs as JSON lines"""
+
+import sys
+import json
+import threading
+from Queue import Queue
+
+from regeneration.battle import messages
+
+__copyright__ = 'Copyright 2011, Petr Viktorin'
+__license__ = 'MIT'
+__email__ = 'encukou@gmail.com'
+
+class JSONLogWriter(object):
+    """A Field observer that writes messages to streams as JSON lines
+
+    outputs is a dict mapping trainers to writable file objects; each stream
+    gets the messages as that trainer sees them. Use None as the key for the
+    public view.
+
+    Messages are buffered, and written out at the end of each turn and
+    battle, or when flush_size messages are pending.
+    With background=True, JSON encoding and writing is done in a separate
+    thread, so the battle doesn't wait for I/O. Message contents are always
+    computed in the calling thread.
+
+    Call close() when done (or use the writer as a context manager) to write
+    out the remaining messages. Errors in the background thread are re-raised
+    on the next flush.
+    """
+    flush_classes = messages.TurnEnd, messages.BattleEnd
+
+    def __init__(self, outputs, flush_size=1000, background=False):
+        self.outputs = list(outputs.items())
+        self.flush_size = flush_size
+        self.pending = []
+        self._error = None
+        if background:
+            self._queue = Queue()
+            self._thread = threading.Thread(target=self._work,
+                    name='JSONLogWriter')
+            self._thread.daemon = True
+            self._thread.start()
+        else:
+            self._queue = None
+            self._thread = None
+
+    def __call__(self, message):
+        self.pending.append(tuple(message.contents(trainer)
+                for trainer, stream in self.outputs))
+        if (isinstance(message, self.flush_classes) or
+                len(self.pending) >= self.flush_size):
+            self.flush()
+
+    def flush(self):
+        """Write out (or hand off to the background thread) pending messages
+        """
+        self._check_error()
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        if self._queue:
+            self._queue.put(batch)
+        else:
+            self._write_batch(batch)
+
+    def close(self):
+        """Flush, and wait until everything is written
+        """
+        self.flush()
+        if self._thread:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+            self._queue = None
+            self._check_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _check_error(self):
+        if self._error:
+            exc_info, self._error = self._error, None
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def _work(self):
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                return
+            if self._error:
+                continue
+            try:
+                self._write_batch(batch)
+            except Exception:
+                self._error = sys.exc_info()
+
+    def _write_batch(self, batch):
+        # Trainers in the same visibility group share contents dicts;
+        # only encode those once
+        encoded = {}
+        for index, (trainer, stream) in enumerate(self.outputs):
+            lines = []
+            for contents in batch:
+                contents = contents[index]
+                try:
+                    line = encoded[id(contents)]
+                except KeyError:
+                    line = encoded[id(contents)] = json.dumps(contents,
+                            sort_keys=True) + '\n'
+                lines.append(line)
+            stream.write(''.join(lines))
+            try:
+                flush = stream.flush
+            except AttributeError:
+                pass
+            else:
+                flush()
@@ -0,0 +1,368 @@
+#! /usr/bin/env python
+# Encoding: UTF-8
+
+"""Monte Carlo tree search trainer
+
+The search tree is a dict mapping state hashes (see Field.state_hash) to
+Nodes, so positions reached by different paths share statistics, and the
+tree can be kept from one decision to the next.
+"""
+
+import math
+import random
+import multiprocessing
+
+from regeneration.battle.search import SearchTrainer, request_options
+from regeneration.battle.search import command_key, hp_balance, WIN_SCORE
+
+__copyright__ = 'Copyright 2011, Petr Viktorin'
+__license__ = 'MIT'
+__email__ = 'encukou@gmail.com'
+
+def random_policy(request, rand):
+    """The default playout policy, modeled on Trainer.get_commands
+
+    Selects a random move 90% of the time, otherwise any random command
+    from request_options (including switches).
+    """
+    options = request_options(request)
+    moves = [command for command in options if command.command == 'move']
+    if moves and rand.random() < 0.9:
+        return rand.choice(moves)
+    else:
+        return rand.choice(options)
+
+def playout_value(field, trainer):
+    """The default playout evaluation: a value between 0 (lost) and 1 (won)
+
+    Unfinished battles are valued by hp_balance, scaled to that range.
+    """
+    value = hp_balance(field, trainer)
+    if value > WIN_SCORE / 2:
+        return 1.0
+    elif value < -WIN_SCORE / 2:
+        return 0.0
+    else:
+        return 0.5 + value / 2
+
+class RandomChance(object):
+    """Decides chance events (see Field.chance) using a random generator
+    """
+    def __init__(self, rand):
+        self.rand = rand
+
+    def flip_coin(self, chance, blurb):
+        return self.rand.randint(0, chance.denominator - 1) < chance.numerator
+
+    def randint(self, min, max, blurb):
+        return self.rand.randint(min, max)
+
+class Node(object):
+    """Search statistics for one position
+
+    visits is the number of times the position was visited. options maps
+    (side, option key) to [visits, total value] lists; side is 0 for the
+    trainer's side and 1 for the others, the option key is a tuple of
+    command_keys, and values are from the point of view of the side.
+    """
+    def __init__(self):
+        self.visits = 0
+        self.options = {}
+
+    def copy(self):
+        node = Node()
+        node.visits = self.visits
+        node.options = dict((key, list(stats))
+                for key, stats in self.options.items())
+        return node
+
+    def add(self, visits, options):
+        """Add visits and option statistics (e.g. from another process)
+        """
+        self.visits += visits
+        for key, (option_visits, value) in options.items():
+            stats = self.options.setdefault(key, [0, 0.0])
+            stats[0] += option_visits
+            stats[1] += value
+
+    def changes(self, old):
+        """Return (visits, options) gathered since old was copied from self
+        """
+        options = {}
+        for key, (visits, value) in self.options.items():
+            old_visits, old_value = old.options.get(key, (0, 0.0))
+            if visits != old_visits:
+                options[key] = [visits - old_visits, value - old_value]
+        return self.visits - old.visits, options
+
+class MCTSTrainer(SearchTrainer):
+    """A trainer that chooses commands by Monte Carlo tree search
+
+    Each iteration of the search walks down the tree in a simulation (see
+    Field.simulation). At each position, each side's commands are chosen
+    separately, by UCB1 with the given exploration constant. Chance events
+    are random. A walk stops if it gets back to a position it went through.
+    The statistics of each side's options start with prior_visits virtual
+    visits: the first option in option_order (the strongest move, by
+    default) is valued as a win, others as a draw. So, with little time to
+    search, the trainer falls back to option_order.
+    When the walk reaches a position that's not in the tree yet, it is added,
+    and the battle is played out from there for at most playout_turns turns,
+    with policy(request, rand) choosing all commands (random_policy by
+    default). The result is valued by evaluate(field, trainer) (playout_value
+    by default), and the value is added to the statistics along the way.
+
+    Each decision takes at most time_limit seconds. The search runs in
+    processes processes (by default, one per CPU): all but one are forked for
+    the decision, so they get a copy of the battle and the tree. Each grows
+    the tree with its own random seed; their statistics are then merged.
+    When there are several processes, the searches stop when the reserve
+    fraction of time_limit is left, to leave time for sending and merging the
+    statistics; statistics that don't arrive in time are not used. No
+    process starts a rollout it likely can't finish in time.
+    The combination of commands with the most visits (counting the prior) is
+    chosen; ties are broken by value, then by option_order.
+
+    The tree is kept between decisions, up to max_nodes nodes: if the battle
+    reaches an explored position, its statistics are reused.
+
+    Throughput is recorded in the stats dict: decisions, rollouts (walks and
+    playouts), reused_visits (visits of the starting positions that were
+    already in the tree), and process_time (the time all processes spent
+    searching). The last decision's numbers are in last_stats. See
+    rollouts_per_second and format_stats.
+    """
+    def __init__(self, name, team, rand=random, time_limit=0.1,
+            processes=None, exploration=math.sqrt(2), playout_turns=20,
+            policy=random_policy, evaluate=playout_value, max_nodes=100000,
+            prior_visits=5, reserve=0.1):
+        super(MCTSTrainer, self).__init__(name, team, rand)
+        self.time_limit = time_limit
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.processes = processes
+        self.exploration = exploration
+        self.playout_turns = playout_turns
+        self.policy = policy
+        self.evaluate = evaluate
+        self.max_nodes = max_nodes
+        self.prior_visits = prior_visits
+        self.reserve = reserve
+        self.nodes = {}
+        self.stats = dict(decisions=0, rollouts=0, reused_visits=0,
+                process_time=0.0)
+        self.last_stats = None
+        # Average duration of a rollout in the last decision
+        self._rollout_time = 0.0
+
+    def search(self, field):
+        start = self.clock()
+        deadline = search_deadline = start + self.time_limit
+        if self.processes > 1:
+            # Leave time for collecting the workers' results
+            search_deadline -= self.time_limit * self.reserve
+        ours, theirs = self.options(field)
+        if len(ours) == 1:
+            return ours[0]
+        if len(self.nodes) > self.max_nodes:
+            self.nodes.clear()
+        root = self.nodes.get(field.state_hash)
+        reused_visits = root.visits if root else 0
+
+        workers = []
+        for i in range(self.processes - 1):
+            receiver, sender = multiprocessing.Pipe(False)
+            worker = multiprocessing.Process(target=self._work,
+                    args=(field, self.rand.getrandbits(64), search_deadline,
+                        sender))
+            worker.daemon = True
+            worker.start()
+            sender.close()
+            workers.append((worker, receiver))
+
+        rand = random.Random(self.rand.getrandbits(64))
+        rollouts, process_time, changes = self.grow_tree(field, rand,
+                search_deadline)
+        for worker, receiver in workers:
+            # Results that aren't in by the deadline are lost
+            result = None
+            if receiver.poll(max(deadline - self.clock(), 0)):
+                try:
+                    result = receiver.recv()
+                except EOFError:
+                    # The worker died (and printed a traceback)
+                    pass
+            receiver.close()
+            # Workers aren't joined: multiprocessing reaps finished processes
+            # when it starts new ones
+            if result:
+                worker_rollouts, worker_time, changes = result
+                rollouts += worker_rollouts
+                process_time += worker_time
+                for key, visits, options in changes:
+                    self.nodes.setdefault(key, Node()).add(visits, options)
+            else:
+                worker.terminate()
+
+        if rollouts:
+            self._rollout_time = process_time / rollouts
+        self.last_stats = dict(rollouts=rollouts, reused_visits=reused_visits,
+                process_time=process_time, processes=self.processes,
+                duration=self.clock() - start)
+        for name in 'rollouts', 'reused_visits', 'process_time':
+            self.stats[name] += self.last_stats[name]
+        self.stats['decisions'] += 1
+
+        root = self.nodes.get(field.state_hash, Node())
+
+        def robustness(item):
+            rank, commands = item
+            key = tuple(command_key(c) for c in commands)
+            visits, value = self.option_stats(root, 0, key, rank)
+            return visits, value / visits if visits else 0.0
+
+        return max(enumerate(ours), key=robustness)[1]
+
+    def _work(self, field, seed, deadline, connection):
+        rollouts, process_time, changes = self.grow_tree(field,
+                random.Random(seed), deadline, track_changes=True)
+        connection.send((rollouts, process_time, changes))
+        connection.close()
+
+    def grow_tree(self, field, rand, deadline, track_changes=False):
+        """Run search iterations until about one iteration before the deadline
+
+        Returns the number of iterations, the time taken, and (if
+        track_changes is true) a list of (state hash, visits, options)
+        changes to the tree, for Node.add; otherwise None.
+        """
+        start = self.clock()
+        rollouts = 0
+        rollout_time = self._rollout_time
+        old_nodes = {} if track_changes else None
+        with field.simulation(RandomChance(rand)):
+            while True:
+                now = self.clock()
+                if rollouts:
+                    rollout_time = (now - start) / rollouts
+                # Don't start a rollout that would likely end after the
+                # deadline
+                if now + rollout_time >= deadline:
+                    break
+                mark = field.mark()
+                path = self.descend(field, rand, old_nodes)
+                value = self.playout(field, rand)
+                field.rollback(mark)
+                for node, our_key, their_key in path:
+                    node.visits += 1
+                    stats = node.options.setdefault((0, our_key), [0, 0.0])
+                    stats[0] += 1
+                    stats[1] += value
+                    stats = node.options.setdefault((1, their_key), [0, 0.0])
+                    stats[0] += 1
+                    stats[1] += 1 - value
+                rollouts += 1
+        if track_changes:
+            changes = []
+            for key, old in old_nodes.items():
+                node = self.nodes[key]
+                if old is None:
+                    changes.append((key, node.visits, node.options))
+                else:
+                    changes.append((key, ) + node.changes(old))
+        else:
+            changes = None
+        return rollouts, self.clock() - start, changes
+
+    def descend(self, field, rand, old_nodes=None):
+        """Walk down the tree, adding one node; return the path taken
+
+        The path is a list of (node, our option key, their option key).
+        If old_nodes is a dict, nodes are copied to it (by state hash) before
+        they are first changed; new nodes are recorded as None.
+        """
+        path = []
+        seen = set()
+        while (not field.ended and field.active_requests and
+                len(path) < self.playout_turns):
+            key = field.state_hash
+            if key in seen:
+                # Went in a circle; count each position once per walk
+                break
+            seen.add(key)
+            node = self.nodes.get(key)
+            if old_nodes is not None and key not in old_nodes:
+                old_nodes[key] = node.copy() if node else None
+            if node is None:
+                node = self.nodes[key] = Node()
+            ours, theirs = self.options(field)
+            our_key, our_commands = self.choose(node, 0, ours, rand)
+            their_key, their_commands = self.choose(node, 1, theirs, rand)
+            path.append((node, our_key, their_key))
+            for command in our_commands + their_commands:
+                command.select()
+            if not node.visits:
+                break
+        return path
+
+    def choose(self, node, side, options, rand):
+        """Choose one side's command combination by UCB1
+
+        The options should be in option_order. Returns the option key and the
+        commands.
+        """
+        keyed = [(tuple(command_key(c) for c in commands), commands)
+                for commands in options]
+        if len(keyed) == 1:
+            return keyed[0]
+        total_visits = node.visits + self.prior_visits * len(keyed)
+
+        def upper_bound(item):
+            rank, (key, commands) = item
+            visits, value = self.option_stats(node, side, key, rank)
+            if not visits:
+                # Unexplored options go first (in option_order)
+                return float('inf')
+            return value / visits + self.exploration * math.sqrt(
+                    math.log(total_visits) / visits)
+
+        return max(enumerate(keyed), key=upper_bound)[1]
+
+    def option_stats(self, node, side, key, rank):
+        """Return [visits, total value] of an option, including the prior
+
+        rank is the option's position in option_order.
+        """
+        visits, value = node.options.get((side, key), (0, 0.0))
+        prior_value = 1.0 if rank == 0 else 0.5
+        return (visits + self.prior_visits,
+                value + self.prior_visits * prior_value)
+
+    def playout(self, field, rand):
+        """Play the battle out with the playout policy; return its value
+        """
+        start = field.turn_number
+        while (not field.ended and field.active_requests and
+                field.turn_number - start < self.playout_turns):
+            requests = [field.active_requests.get(spot.battler)
+                    for spot in field.spots]
+            for request in requests:
+                if request:
+                    self.policy(request, rand).select()
+        return self.evaluate(field, self)
+
+    def rollouts_per_second(self):
+        """Return the average number of rollouts per second per process
+        """
+        if not self.stats['process_time']:
+            return 0.0
+        return self.stats['rollouts'] / self.stats['process_time']
+
+    def format_stats(self):
+        """Return a one-line summary of the search throughput
+        """
+        return ('%s: %s rollouts in %s decisions, %.1f rollouts/s per '
+                'process (%s processes), %s reused visits' % (
+                    self.name, self.stats['rollouts'],
+                    self.stats['decisions'], self.rollouts_per_second(),
+                    self.processes, self.stats['reused_visits']))
@@ -12,14 +12,57 @@ __email__ = 'encukou@gmail.com'
 def message_values(obj, trainer):
     return obj.message_values(trainer)
 
-for type_ in (int, unicode, bool, type(None)):
+scalar_types = frozenset((int, unicode, bool, type(None)))
+
+for type_ in scalar_types:
     @multimethod(type_, object)
     def message_values(scalar, trainer):
         return scalar
 
+def message_visibility(obj, trainer):
+    """Return the visibility group of trainer's view of obj
+
+    Objects whose message_values depend on the trainer must define a
+    message_visibility(trainer) method. It returns None if the trainer sees
+    the public values (the ones message_values gives for trainer=None), or a
+    hashable key that is the same for all trainers who see identical values
+    (e.g. 'owner').
+    Objects without the method are public to everyone.
+    """
+    if type(obj) in scalar_types:
+        return None
+    try:
+        get_visibility = obj.message_visibility
+    except AttributeError:
+        return None
+    return get_visibility(trainer)
+
 class MessageArgument(object):
     pass
 
+def _compile_serializer(registry_name, argument_names):
+    """Generate a function that creates contents of a message
+
+    The function takes the message's arguments dict and the trainer, and
+    returns the same thing as calling message_values on each argument would.
+    Scalar values are copied directly, without multimethod dispatch.
+    """
+    namespace = dict(registry_name=registry_name, type=type,
+            scalar_types=scalar_types, message_values=message_values)
+    lines = ['def serialize(arguments, trainer):']
+    for index, name in enumerate(argument_names):
+        lines.append('    value_%s = arguments[%r]' % (index, name))
+        lines.append('    if type(value_%s) not in scalar_types:' % index)
+        lines.append('        value_%s = message_values(value_%s, trainer)' %
+                (index, index))
+    lines.append("    return {'class': registry_name,")
+    for index, name in enumerate(argument_names):
+        lines.append('        %r: value_%s,' % (name, index))
+    lines.append('    }')
+    exec compile('\n'.join(lines), '<%s serializer>' % registry_name,
+            'exec') in namespace
+    return namespace['serialize']
+
 
 message_registry = {}
 
@@ -49,6 +92,8 @@ class MessageMeta(Mapping.__metaclass__):
                 )
         message_registry[registry_name] = cls
         cls.argument_types = argument_types
+        cls.serialize_arguments = staticmethod(
+                _compile_serializer(registry_name, sorted(argument_types)))
         return cls
 
 class Message(Mapping):
@@ -58,6 +103,8 @@ class Message(Mapping):
 
     def __init__(self, field, **kwargs):
         self.arguments = dict()
+        self._visibility_contents = dict()
+        self._view = None
         _contents = kwargs.get('_contents')
         if _contents:
             self._contents = _contents
@@ -70,23 +117,63 @@ class Message(Mapping):
             raise ValueError("Extra keyword arguments: %s" % ', '.join(kwargs))
 
     def contents(self, trainer=None, save=True):
+        """Return the message's values as seen by the given trainer
+
+        Trainers in the same visibility groups (see message_visibility) share
+        the returned dict: it's the public contents, with any
+        viewer-dependent values replaced.
+        """
         try:
             return self._contents[trainer]
         except KeyError:
-            contents = dict()
-            contents['class'] = self.registry_name
-            for name, arg_type in self.argument_types.items():
-                value = self.arguments[name]
-                contents[name] = message_values(value, trainer)
-            if save:
-                self._contents[trainer] = contents
-            return contents
+            pass
+        if trainer is None:
+            contents = self.serialize_arguments(self.arguments, None)
+        else:
+            public = self.contents(None, save)
+            overlay = []
+            for name, value in self.arguments.items():
+                visibility = message_visibility(value, trainer)
+                if visibility is not None:
+                    overlay.append((name, visibility))
+            if overlay:
+                key = tuple(overlay)
+                try:
+                    contents = self._visibility_contents[key]
+                except KeyError:
+                    contents = dict(public)
+                    for name, visibility in overlay:
+                        contents[name] = message_values(self.arguments[name],
+                                trainer)
+                    if save:
+                        self._visibility_contents[key] = contents
+            else:
+                contents = public
+        if save:
+            self._contents[trainer] = contents
+        return contents
+
+    @property
+    def view(self):
+        """Read-only attribute access to the public contents
+
+        Nested dicts are wrapped in views as well. Views are created on first
+        access and reused.
+        """
+        view = self._view
+        if view is None:
+            view = self._view = _ValueProxy(self.contents())
+        return view
 
     def __getattr__(self, attr):
-        return getattr(_ValueProxy(self.contents()), attr)
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        value = getattr(self.view, attr)
+        self.__dict__[attr] = value
+        return value
 
     def __getitem__(self, item):
-        return getattr(_ValueProxy(self.contents()), item)
+        return getattr(self.view, item)
 
     def __iter__(self):
         return iter(self.argument_types)
@@ -101,24 +188,39 @@ class Message(Mapping):
         return unicode(self).encode('utf-8')
 
 class _ValueProxy(object):
+    """Read-only view of a contents dict
+
+    Looked-up values (and views of nested dicts) are cached in the instance
+    dict, so repeated access doesn't go through __getattr__.
+    """
     def __init__(self, dct):
-        self.dict = dct
+        self.__dict__['_dict'] = dct
 
     def __getattr__(self, attr):
+        if attr.startswith('_'):
+            # Also avoids infinite recursion before _dict is set (e.g. when
+            # copying or unpickling)
+            raise AttributeError(attr)
         try:
-            value = self.dict[attr]
+            value = self._dict[attr]
         except KeyError:
             raise AttributeError(attr)
         if isinstance(value, dict):
-            return _ValueProxy(value)
-        else:
-            return value
+            value = _ValueProxy(value)
+        self.__dict__[attr] = value
+        return value
+
+    def __setattr__(self, attr, value):
+        raise AttributeError('Message values are read-only')
+
+    def __delattr__(self, attr):
+        raise AttributeError('Message values are read-only')
 
     def __repr__(self):
-        return "<%s>" % self.dict
+        return "<%s>" % self._dict
 
     def __unicode__(self):
-        return self.dict.get('name', '<?>')
+        return self._dict.get('name', '<?>')
 
 
 class BattleStart(Message):
@@ -217,6 +319,7 @@ def effectivity(hit, **kwargs):
         return NormallyEffective(hit=hit, **kwargs)
     else:
         return SuperEffective(hit=hit, **kwargs)
+effectivity.message_class = EffectivityBase
 
 class Miss(Message):
     message = "{hit.moveeffect.user}'s attack missed."
@@ -27,6 +27,9 @@ class Monster(object):
     """
     MoveClass = Move
 
+    # Identifies the monster in state hash features (see Field.state_features)
+    state_id = None
+
     def __init__(self, form, level, loader, rand=random, _load_moves=True):
         """ Create a random Monster of the given species and level.
 
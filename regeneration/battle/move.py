@@ -21,6 +21,8 @@ class Move(object):
 
     Anything that is reset after switching out is not included here.
     """
+    # Identifies the move in state hash features (see Field.state_features)
+    state_id = None
 
     def __init__(self, kind, maxpp=None):
         """ Create a move.
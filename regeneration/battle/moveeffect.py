@@ -95,6 +95,7 @@ class MoveEffect(object):
         self.targets = list(self.get_targets(**kwargs))
         self.deduct_pp()
         self.user.used_move_effects.append(self)
+        self.field.record(self.user.used_move_effects.pop)
         hits = self.use(**kwargs)
         if hits:
             Effect.move_hits_done(self, [hit for hit in hits if hit])
@@ -211,6 +212,12 @@ class MoveEffect(object):
     def deduct_pp(self):
         if self.ppless not in self.flags:
             delta = -min(self.move.pp, Effect.pp_reduction(self, 1))
+            self.field.record_setattr(self.move, 'pp')
+            state_id = self.move.state_id
+            if state_id is not None:
+                self.field.remove_state_feature('pp', state_id, self.move.pp)
+                self.field.add_state_feature('pp', state_id,
+                        self.move.pp + delta)
             self.move.pp += delta
             self.field.message.PPChange(move=self.move, battler=self.user,
                     delta=delta, pp=self.move.pp, cause=self)
@@ -232,8 +239,14 @@ class MoveEffect(object):
         else:
             return Effect.force_critical_hit(self)
 
-    def message_values(self, trainer):
+    def message_visibility(self, trainer):
         if trainer == self.user.trainer and self.target:
+            return 'owner'
+        else:
+            return None
+
+    def message_values(self, trainer):
+        if self.message_visibility(trainer) == 'owner':
             target = self.target.message_values(trainer)
         else:
             target = None
@@ -269,6 +282,9 @@ class Hit(object):
             effectivity *= Fraction(efficacy.damage_factor, 100)
         return Effect.modify_effectivity(self, effectivity)
 
+    def message_visibility(self, trainer):
+        return self.move_effect.message_visibility(trainer)
+
     def message_values(self, trainer):
         return dict(
                 moveeffect=self.move_effect.message_values(trainer),
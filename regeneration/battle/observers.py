@@ -0,0 +1,127 @@
+#! /usr/bin/env python
+# Encoding: UTF-8
+
+"""Observer adapters"""
+
+import sys
+import threading
+from Queue import Queue, Full, Empty
+
+__copyright__ = 'Copyright 2011, Petr Viktorin'
+__license__ = 'MIT'
+__email__ = 'encukou@gmail.com'
+
+# Queued to stop the worker
+_stop = object()
+
+class QueuedObserver(object):
+    """Calls a (slow) observer from a worker thread, so it can't stall battles
+
+    Messages are put on a queue of at most maxsize items. The policy decides
+    what happens when the observer falls behind:
+    - 'block': when the queue is full, wait until the worker catches up
+    - 'drop': when the queue is full, discard the new message
+    - 'drop_oldest': when the queue is full, discard the oldest message
+    - 'coalesce': replace a still-queued message with the same key
+    For 'coalesce', the key function must be given: a message replaces a
+    queued one if key(message) is the same, and takes its place in the
+    queue. Other messages wait when the queue is full.
+    The number of discarded messages is kept in the dropped attribute.
+
+    Before a message is queued, its contents are computed (and cached in the
+    message) for each of the given trainers (None is the public view), so
+    the observer sees the state from when the message was sent.
+
+    Call close() to wait for the queue to drain and stop the worker (or use
+    the adapter as a context manager). An exception raised by the observer
+    stops delivery; it is re-raised from the next call or from close().
+    """
+    policies = 'block', 'drop', 'drop_oldest', 'coalesce'
+
+    def __init__(self, observer, maxsize=1000, policy='block',
+            trainers=(None, ), key=None):
+        if policy not in self.policies:
+            raise ValueError('Unknown policy: %s' % policy)
+        if (policy == 'coalesce') != (key is not None):
+            raise ValueError('A key must be given for (only) coalescing')
+        self.observer = observer
+        self.key = key
+        self.policy = policy
+        self.trainers = trainers
+        self.dropped = 0
+        self._error = None
+        self._queue = Queue(maxsize)
+        # For coalescing: the queue holds keys; messages are kept here
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._work,
+                name='QueuedObserver')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __call__(self, message):
+        self._check_error()
+        if self._thread is None:
+            raise ValueError('Observer is closed')
+        for trainer in self.trainers:
+            message.contents(trainer)
+        if self.policy == 'block':
+            self._queue.put(message)
+            return
+        elif self.policy == 'coalesce':
+            key = self.key(message)
+            with self._lock:
+                if key in self._pending:
+                    self._pending[key] = message
+                    self.dropped += 1
+                    return
+                self._pending[key] = message
+            self._queue.put(key)
+            return
+        while True:
+            try:
+                self._queue.put_nowait(message)
+                return
+            except Full:
+                self.dropped += 1
+                if self.policy == 'drop':
+                    return
+                try:
+                    self._queue.get_nowait()
+                except Empty:
+                    self.dropped -= 1
+
+    def close(self):
+        """Wait until all queued messages are delivered, and stop the worker
+        """
+        if self._thread:
+            self._queue.put(_stop)
+            self._thread.join()
+            self._thread = None
+        self._check_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _check_error(self):
+        if self._error:
+            exc_info, self._error = self._error, None
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def _work(self):
+        while True:
+            message = self._queue.get()
+            if message is _stop:
+                return
+            if self.policy == 'coalesce':
+                with self._lock:
+                    message = self._pending.pop(message)
+            if self._error:
+                continue
+            try:
+                self.observer(message)
+            except Exception:
+                self._error = sys.exc_info()
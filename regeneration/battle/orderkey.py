@@ -8,8 +8,16 @@ which can act as sort keys, and to which items may be added at any time,
 in any place, without disturbing the order of the original keys.
 """
 
-# Currently implemented as a doubly-linked list, with Fraction ids for
-# comparisons.
+# Currently implemented as a doubly-linked list, with integer ids for
+# comparisons. A new key gets the id halfway between its neighbours; when
+# there is no gap left, a range of ids around it is relabelled (this is a
+# simple order-maintenance structure, as described by Dietz & Sleator or
+# Bender et al.), so the ids stay small integers.
+#
+# Each key also has a rank, an integer usable as a sort key. It is the same
+# as the id until freeze() is called; after that it is the index of the id
+# among the ids of all keys, in all sequences. So ranks of any two keys
+# compare the same way as the keys.
 
 # Copyright (c) 2010, Petr Viktorin
 #
@@ -39,8 +47,48 @@ __copyright__ = 'Copyright 2011, Petr Viktorin'
 __license__ = 'MIT'
 __email__ = 'encukou@gmail.com'
 
-from fractions import Fraction
 import itertools
+import weakref
+from operator import attrgetter
+
+# Difference between the ids of a key and a new one added at an end
+END_SPACING = 2 ** 16
+
+# Relabelling density factor T (between 1 and 2). A range of 2**level ids
+# may be relabelled if it holds at most (2 / T) ** level keys.
+RELABEL_FACTOR = 1.5
+
+# All sequences, so they can be ranked together
+_all_sequences = weakref.WeakSet()
+
+# True once freeze() was called
+_frozen = False
+
+def freeze():
+    """Give the keys of all sequences dense ranks (0, 1, 2, ...)
+
+    Call this when the keys are not expected to change any more, e.g.
+    after plugins are loaded. Keys may still be added after freezing, but
+    each addition re-ranks all keys.
+
+    Keys of different sequences are ranked together, so ranks always
+    compare the same way as the keys themselves.
+    """
+    global _frozen
+    if not _frozen:
+        _frozen = True
+        _rerank()
+
+def _rerank():
+    keys = sorted((key for sequence in list(_all_sequences)
+            for key in sequence), key=attrgetter('id'))
+    rank = -1
+    last_id = None
+    for key in keys:
+        if key.id != last_id:
+            rank += 1
+            last_id = key.id
+        key.rank = rank
 
 class OrderKeys(object):
     """An extensible ordering key class
@@ -54,6 +102,8 @@ class OrderKeys(object):
     """
     def __init__(self, length=1):
         self.first = self.last = OrderKey(_keys=self)
+        _all_sequences.add(self)
+        self._added(self.first)
         for i in range(length - 1):
             self.new_last()
 
@@ -88,8 +138,44 @@ class OrderKeys(object):
             yield yv
             yv = yv.prev
 
+    def _relabel(self, key):
+        """Make room for a new id right after the given key
+
+        Finds the smallest aligned range of ids around key that is sparse
+        enough, and spreads the keys in it evenly. Keys outside the range are
+        not touched, so the order is kept.
+        """
+        first = last = key
+        count = 1
+        level = 0
+        while True:
+            level += 1
+            size = 2 ** level
+            base = key.id & ~(size - 1)
+            while first.prev and first.prev.id >= base:
+                first = first.prev
+                count += 1
+            while last.next and last.next.id < base + size:
+                last = last.next
+                count += 1
+            if count <= (2 / RELABEL_FACTOR) ** level:
+                break
+        step = size // count
+        relabelled = first
+        for i in range(count):
+            relabelled.id = base + i * step
+            if not _frozen:
+                relabelled.rank = relabelled.id
+            relabelled = relabelled.next
+
+    def _added(self, key):
+        if _frozen:
+            _rerank()
+        else:
+            key.rank = key.id
+
 class OrderKey(object):
-    __slots__ = 'prev next keys id'.split()
+    __slots__ = 'prev next keys id rank'.split()
 
     def __init__(self, _parent=None, _keys=None):
         """An order key. Not meant to be instantiated directly.
@@ -97,42 +183,54 @@ class OrderKey(object):
         self.keys = _keys or _parent.keys
         if _parent is None:
             self.prev = self.next = None
-            self.id = 0
+            self.id = self.rank = 0
         else:
             self.prev = _parent.prev
             self.next = _parent.next
-            self.id = 0
+            self.id = self.rank = 0
 
     def new_before(self, number=None):
         """Create a new key that comes before this one and return it"""
         if number is not None:
             return list(reversed([self.new_before() for i in range(number)]))
+        prev = self.prev
+        if prev:
+            if self.id - prev.id < 2:
+                self.keys._relabel(prev)
+            new_id = (self.id + prev.id) // 2
+        else:
+            new_id = self.id - END_SPACING
         rv = OrderKey(self)
+        rv.id = new_id
         rv.next = self
-        prev = self.prev
         self.prev = rv
         if prev:
             prev.next = rv
-            rv.id = Fraction(self.id + prev.id) / 2
         else:
             self.keys.first = rv
-            rv.id = self.id - 1
+        self.keys._added(rv)
         return rv
 
     def new_after(self, number=None):
         """Create a new key that comes after this one and return it"""
         if number is not None:
             return [self.new_after() for i in range(number)]
+        next = self.next
+        if next:
+            if next.id - self.id < 2:
+                self.keys._relabel(self)
+            new_id = (self.id + next.id) // 2
+        else:
+            new_id = self.id + END_SPACING
         rv = OrderKey(self)
+        rv.id = new_id
         rv.prev = self
-        next = self.next
         self.next = rv
         if next:
             next.prev = rv
-            rv.id = Fraction(self.id + next.id) / 2
         else:
             self.keys.last = rv
-            rv.id = self.id + 1
+        self.keys._added(rv)
         return rv
 
     def __str__(self):
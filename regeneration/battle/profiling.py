@@ -0,0 +1,173 @@
+#! /usr/bin/env python
+# Encoding: UTF-8
+
+"""Profiling of Effect callbacks
+
+A HookProfiler records, for each callback (hook) and for each effect class
+implementing it, how many times it was called and how long it took.
+
+    profiler = HookProfiler()
+    with profiler:
+        field.run()
+    print profiler.format_table()
+
+While enabled, the profiler replaces the run_all and get_effect_methods
+methods of all callbacks with instrumented versions. When it is disabled,
+the original methods are used again, so there's no overhead at all.
+"""
+
+import json
+from timeit import default_timer
+
+from regeneration.battle.effect import callback
+
+__copyright__ = 'Copyright 2011, Petr Viktorin'
+__license__ = 'MIT'
+__email__ = 'encukou@gmail.com'
+
+class HookStats(object):
+    """Statistics for one hook, or one effect class's implementation of it
+    """
+    def __init__(self):
+        self.calls = 0
+        self.listeners = 0
+        self.time = 0.0
+
+    def as_dict(self):
+        return dict(calls=self.calls, listeners=self.listeners,
+                time=self.time)
+
+class HookProfiler(object):
+    """Records call counts, listener counts and wall time of Effect callbacks
+
+    The hooks attribute maps hook names to HookStats; listeners maps
+    (hook name, effect class name) pairs to HookStats (where the listeners
+    count is not used).
+    Times include any hooks called from within a hook.
+
+    Only one profiler may be enabled at a time.
+    """
+    enabled_profiler = None
+
+    def __init__(self):
+        self.hooks = {}
+        self.listeners = {}
+
+    def __enter__(self):
+        self.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.disable()
+
+    def enable(self):
+        if HookProfiler.enabled_profiler is not None:
+            raise RuntimeError('A HookProfiler is already enabled')
+        HookProfiler.enabled_profiler = self
+        for hook in callback.instances:
+            self._instrument(hook)
+
+    def disable(self):
+        if HookProfiler.enabled_profiler is not self:
+            raise RuntimeError('This HookProfiler is not enabled')
+        for hook in callback.instances:
+            del hook.run_all
+            del hook.get_effect_methods
+            hook.bound.clear()
+        HookProfiler.enabled_profiler = None
+
+    def reset(self):
+        self.hooks.clear()
+        self.listeners.clear()
+
+    def _get_stats(self, dct, key):
+        try:
+            return dct[key]
+        except KeyError:
+            stats = dct[key] = HookStats()
+            return stats
+
+    def _instrument(self, hook):
+        name = hook.name
+        # Chains are normally run by generated code; use the generic way
+        # so that listeners can be instrumented
+        run_all = getattr(hook, 'run_generic', hook.run_all)
+        get_effect_methods = hook.get_effect_methods
+        hook_stats = self._get_stats(self.hooks, name)
+
+        def profiled_run_all(owner, object, *args):
+            hook_stats.calls += 1
+            start = default_timer()
+            try:
+                return run_all(owner, object, *args)
+            finally:
+                hook_stats.time += default_timer() - start
+
+        def profiled_get_effect_methods(owner, object, arguments,
+                with_effects=False):
+            for effect, method in get_effect_methods(owner, object,
+                    arguments, with_effects=True):
+                hook_stats.listeners += 1
+                method = self._profiled_method(name, effect, method)
+                if with_effects:
+                    yield effect, method
+                else:
+                    yield method
+
+        hook.run_all = profiled_run_all
+        hook.get_effect_methods = profiled_get_effect_methods
+        hook.bound.clear()
+
+    def _profiled_method(self, name, effect, method):
+        # (The method may be a plain function set on the effect instance)
+        effect_class = type(effect)
+        key = name, '%s.%s' % (effect_class.__module__, effect_class.__name__)
+        stats = self._get_stats(self.listeners, key)
+
+        def profiled_method(*args):
+            stats.calls += 1
+            start = default_timer()
+            try:
+                return method(*args)
+            finally:
+                stats.time += default_timer() - start
+        return profiled_method
+
+    def as_dict(self):
+        """Return the results as a dict that can be serialized to JSON
+        """
+        hooks = dict((name, stats.as_dict())
+                for name, stats in self.hooks.items() if stats.calls)
+        for (name, class_name), stats in self.listeners.items():
+            hook = hooks.setdefault(name, self.hooks[name].as_dict())
+            listeners = hook.setdefault('effect_classes', {})
+            listeners[class_name] = dict(calls=stats.calls, time=stats.time)
+        return hooks
+
+    def dump_json(self, stream, **kwargs):
+        """Write the results as JSON to a stream
+        """
+        json.dump(self.as_dict(), stream, **kwargs)
+
+    def format_table(self):
+        """Return the results as a table, slowest hooks first
+        """
+        rows = []
+        hooks = sorted(self.as_dict().items(), key=lambda item: (
+                -item[1]['time'], item[0]))
+        for name, hook in hooks:
+            rows.append((name, hook['calls'], hook['listeners'],
+                    hook['time']))
+            listeners = sorted(hook.get('effect_classes', {}).items(),
+                    key=lambda item: (-item[1]['time'], item[0]))
+            for class_name, stats in listeners:
+                rows.append(('    ' + class_name, stats['calls'], '',
+                        stats['time']))
+        width = max([len(row[0]) for row in rows] + [20])
+        row_format = '%%-%ss %%10s %%10s %%12s' % width
+        lines = [row_format % ('hook / effect class', 'calls', 'listeners',
+                'time [ms]')]
+        for name, calls, listeners, time in rows:
+            lines.append(row_format % (name, calls, listeners,
+                    '%.3f' % (time * 1000)))
+        return '\n'.join(lines)
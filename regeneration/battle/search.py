@@ -0,0 +1,363 @@
+#! /usr/bin/env python
+# Encoding: UTF-8
+
+"""Trainers that choose commands by searching possible futures of the battle
+
+The searches run turns on the real field inside Field.simulation, and roll
+each one back when they're done with it.
+"""
+
+import time
+import random
+import itertools
+
+from regeneration.battle.trainer import Trainer
+from regeneration.battle.command import MoveCommand
+
+__copyright__ = 'Copyright 2011, Petr Viktorin'
+__license__ = 'MIT'
+__email__ = 'encukou@gmail.com'
+
+# Heuristic value of a won battle; HP-based values are much smaller
+WIN_SCORE = 1000
+
+def side_trainers(side):
+    """Return the trainers fighting on a side, without duplicates
+    """
+    trainers = []
+    for spot in side.spots:
+        if spot.trainer not in trainers:
+            trainers.append(spot.trainer)
+    return trainers
+
+def hp_fraction(side):
+    """Return the average fraction of HP left in a side's monsters
+    """
+    total = 0.0
+    count = 0
+    for trainer in side_trainers(side):
+        for monster in trainer.team:
+            total += float(max(monster.hp, 0)) / monster.stats.hp
+            count += 1
+    return total / count
+
+def hp_balance(field, trainer):
+    """The default search heuristic
+
+    Values a position by the trainer's side's fraction of HP left, minus
+    the average of the other sides' fractions.
+    Won and lost battles are worth WIN_SCORE and -WIN_SCORE on top of that.
+    """
+    ours = []
+    theirs = []
+    for side in field.sides:
+        if trainer in side_trainers(side):
+            ours.append(side)
+        else:
+            theirs.append(side)
+    own_fraction = sum(hp_fraction(s) for s in ours) / len(ours)
+    value = own_fraction - sum(hp_fraction(s) for s in theirs) / len(theirs)
+    if field.ended:
+        if own_fraction > 0:
+            value += WIN_SCORE
+        elif value < 0:
+            value -= WIN_SCORE
+    return value
+
+def request_options(request):
+    """List the commands a search should try for a request
+
+    These are the allowed moves, once for each possible target, and
+    switches. Items and running are not considered.
+    """
+    options = []
+    for command in request.moves():
+        targets = command.possible_targets
+        if len(targets) > 1:
+            options.extend(MoveCommand(request, command.move, target)
+                    for target in targets)
+        else:
+            options.append(command)
+    options.extend(request.switches())
+    return options
+
+def command_key(command):
+    """Return a key identifying a command in a given battle state
+
+    Unlike the commands themselves, keys are equal in copies of the battle
+    (e.g. in other processes).
+    """
+    if command.command == 'move':
+        move = command.move
+        target = command.target
+        return ('move', move.state_id or move.kind.identifier,
+                target.state_id if target is not None else None)
+    else:
+        return 'switch', command.replacement.state_id
+
+def default_option_order(command):
+    """Sort key for commands: strong moves first, then switches
+    """
+    if command.command == 'move':
+        return 0, -(command.move.power or 0)
+    else:
+        return 1, 0
+
+def compatible(commands):
+    """Return false if commands would switch in the same monster twice
+    """
+    replacements = [c.replacement for c in commands if c.command == 'switch']
+    for i, replacement in enumerate(replacements):
+        if any(r is replacement for r in replacements[:i]):
+            return False
+    return True
+
+class ChanceScript(object):
+    """Decides chance events during a simulated turn, by a script
+
+    Used as Field.chance. Each chance event has a few options: a coin flip
+    has two, and randint splits its range into up to bucket_count buckets,
+    each represented by its middle value.
+    The script is a list of option indices for the branching events, in the
+    order the events happen. Events past its end take their first option,
+    and extend the script.
+    An option is only branched into if the probability of reaching it (given
+    the options taken before) is at least min_probability. If fewer than two
+    options qualify, the event isn't a branching one: its likeliest option
+    is taken.
+
+    After the turn, sizes holds the number of options at each branching
+    event, and probability the probability of the options taken.
+    """
+    def __init__(self, script, bucket_count=3, min_probability=0.1):
+        self.script = script
+        self.bucket_count = bucket_count
+        self.min_probability = min_probability
+        self.sizes = []
+        self.probability = 1.0
+
+    def choose(self, options):
+        """Choose from a list of (value, probability) pairs
+        """
+        threshold = self.min_probability / self.probability
+        branches = [o for o in options if o[1] >= threshold]
+        if len(branches) < 2:
+            return max(options, key=lambda o: o[1])[0]
+        position = len(self.sizes)
+        if position == len(self.script):
+            self.script.append(0)
+        self.sizes.append(len(branches))
+        value, probability = branches[self.script[position]]
+        self.probability *= probability
+        return value
+
+    def flip_coin(self, chance, blurb):
+        if chance <= 0:
+            return False
+        elif chance >= 1:
+            return True
+        chance = float(chance)
+        return self.choose([(True, chance), (False, 1 - chance)])
+
+    def randint(self, min, max, blurb):
+        size = max - min + 1
+        count = size if size < self.bucket_count else self.bucket_count
+        options = []
+        for i in range(count):
+            start = min + i * size // count
+            end = min + (i + 1) * size // count
+            options.append(((start + end - 1) // 2,
+                    float(end - start) / size))
+        return self.choose(options)
+
+    def next_script(self):
+        """Return the script for the next outcome, or None if this was the last
+        """
+        script = self.script[:len(self.sizes)]
+        while script and script[-1] + 1 >= self.sizes[len(script) - 1]:
+            script.pop()
+        if not script:
+            return None
+        script[-1] += 1
+        return script
+
+class OutOfTime(Exception):
+    """Raised inside a search when its time is up"""
+
+class SearchTrainer(Trainer):
+    """Base for trainers that choose commands by searching simulated turns
+
+    Subclasses implement search(field), which returns the commands for all
+    the trainer's side's pending requests. (When the trainer controls several
+    battlers, their commands are chosen by one search.)
+    While someone else is simulating the battle, request_command returns
+    None.
+    Time limits are measured by clock(), which returns the time in seconds
+    (time.time by default).
+    """
+    option_order = staticmethod(default_option_order)
+    clock = staticmethod(time.time)
+
+    _plan_key = None
+
+    def request_command(self, request):
+        field = request.field
+        if field.simulating:
+            # Someone else is searching; they'll select the command
+            return None
+        plan_key = field, field.turn_number, field.state
+        if self._plan_key == plan_key and request.battler in self._plan:
+            return self._plan.pop(request.battler)
+        self._plan = dict((c.battler, c) for c in self.search(field))
+        self._plan_key = plan_key
+        return self._plan.pop(request.battler)
+
+    def search(self, field):
+        """Return the best combination of commands for the trainer's side
+        """
+        raise NotImplementedError()
+
+    def options(self, field):
+        """Return command combinations for the pending requests
+
+        Returns a list for the trainer's side and one for the other sides.
+        Commands for each request are sorted by option_order.
+        """
+        ours = []
+        theirs = []
+        for spot in field.spots:
+            request = field.active_requests.get(spot.battler)
+            if request:
+                options = sorted(request_options(request),
+                        key=self.option_order)
+                if self in side_trainers(spot.side):
+                    ours.append(options)
+                else:
+                    theirs.append(options)
+        return ([c for c in itertools.product(*ours) if compatible(c)],
+                [c for c in itertools.product(*theirs) if compatible(c)])
+
+class ExpectiminimaxTrainer(SearchTrainer):
+    """A trainer that chooses commands by depth-limited expectiminimax
+
+    For each decision, the trainer simulates turns with every combination of
+    commands for the pending requests (see request_options). Its own side
+    maximizes the value of the outcome; the other sides minimize it,
+    answering the trainer's commands as if they knew them. Chance events are
+    branched over (see ChanceScript) and the outcomes are averaged by their
+    probability. Positions depth turns ahead, or where the battle ended, are
+    valued by heuristic(field, trainer). (Sending out replacements for
+    fainted monsters doesn't count as a turn.)
+
+    The search is deepened one turn at a time until max_depth, or until
+    time_limit seconds run out; the deepest complete search decides.
+    Commands are tried in option_order (see default_option_order), except
+    at the top, where the best ones from the previous depth go first. Replies
+    that can't make a command worse than the best one found so far are
+    not searched.
+    Values of positions are cached by their state hash, up to cache_size
+    entries. The depth of the last search is kept in last_depth, and the
+    number of turns it simulated in simulated_turns.
+    """
+    def __init__(self, name, team, rand=random, max_depth=3, time_limit=0.1,
+            heuristic=hp_balance, option_order=default_option_order,
+            chance_buckets=3, min_chance_probability=0.1, cache_size=100000):
+        super(ExpectiminimaxTrainer, self).__init__(name, team, rand)
+        self.max_depth = max_depth
+        self.time_limit = time_limit
+        self.heuristic = heuristic
+        self.option_order = option_order
+        self.chance_buckets = chance_buckets
+        self.min_chance_probability = min_chance_probability
+        self.cache_size = cache_size
+        self.cache = {}
+        self.last_depth = 0
+        self.simulated_turns = 0
+        self._deadline = None
+
+    def search(self, field):
+        self._deadline = self.clock() + self.time_limit
+        self.last_depth = 0
+        self.simulated_turns = 0
+        ours, theirs = self.options(field)
+        best = ours[0]
+        if len(ours) == 1:
+            return best
+        with field.simulation():
+            for depth in range(1, self.max_depth + 1):
+                try:
+                    values = self.minimax(field, ours, theirs, depth)
+                except OutOfTime:
+                    break
+                ranked = sorted(zip(values, range(len(ours))),
+                        key=lambda pair: (-pair[0], pair[1]))
+                ours = [ours[i] for value, i in ranked]
+                best = ours[0]
+                self.last_depth = depth
+        return best
+
+    def minimax(self, field, ours, theirs, depth):
+        """Return values of our command combinations
+
+        Values of combinations worse than the best one may only be upper
+        bounds.
+        """
+        best = None
+        values = []
+        for our_commands in ours:
+            worst = None
+            for their_commands in theirs:
+                value = self.expectation(field, our_commands + their_commands,
+                        depth)
+                if worst is None or value < worst:
+                    worst = value
+                    if best is not None and worst <= best:
+                        break
+            values.append(worst)
+            if best is None or worst > best:
+                best = worst
+        return values
+
+    def expectation(self, field, commands, depth):
+        """Return the expected value of a turn with the given commands
+        """
+        if field.state == 'waiting_replacements':
+            # Sending out replacements doesn't count as a turn
+            depth += 1
+        total = weight = 0.0
+        script = []
+        while script is not None:
+            if self.clock() > self._deadline:
+                raise OutOfTime()
+            chance = ChanceScript(script, self.chance_buckets,
+                    self.min_chance_probability)
+            mark = field.mark()
+            try:
+                field.chance = chance
+                for command in commands:
+                    command.select()
+                self.simulated_turns += 1
+                value = self.value(field, depth - 1)
+            finally:
+                field.rollback(mark)
+            total += value * chance.probability
+            weight += chance.probability
+            script = chance.next_script()
+        return total / weight
+
+    def value(self, field, depth):
+        """Return the value of the current position, searched depth turns
+        """
+        if field.ended or depth <= 0 or not field.active_requests:
+            return self.heuristic(field, self)
+        key = field.state_hash, depth
+        try:
+            return self.cache[key]
+        except KeyError:
+            pass
+        ours, theirs = self.options(field)
+        value = max(self.minimax(field, ours, theirs, depth))
+        if len(self.cache) >= self.cache_size:
+            self.cache.clear()
+        self.cache[key] = value
+        return value
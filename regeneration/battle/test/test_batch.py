@@ -0,0 +1,113 @@
+#! /usr/bin/env python
+# Encoding: UTF-8
+
+import copy
+
+import pytest
+
+from regeneration.battle.test import QuietTestCase
+from regeneration.battle.test.test_field import battle_description
+
+from regeneration.battle import batch
+from regeneration.battle.example import Loader
+from regeneration.battle.trainer import Trainer
+
+__copyright__ = 'Copyright 2011, Petr Viktorin'
+__license__ = 'MIT'
+__email__ = 'encukou@gmail.com'
+
+def unseeded_description():
+    description = copy.deepcopy(battle_description)
+    del description['seed']
+    for trainer in description['trainers'].values():
+        del trainer['seed']
+    return description
+
+def without_durations(outcomes):
+    outcomes = [dict(outcome) for outcome in outcomes]
+    for outcome in outcomes:
+        del outcome['duration']
+    return sorted(outcomes, key=lambda outcome: outcome['battle_id'])
+
+class StrongLoader(Loader):
+    """Loads moves that knock out anything in one hit"""
+    def load_move(self, identifier):
+        move = super(StrongLoader, self).load_move(identifier)
+        move.power = 1000
+        return move
+
+strong_loader = StrongLoader()
+
+loaded_trainer_names = []
+
+def recording_trainer_loader(dct, loader):
+    loaded_trainer_names.append(dct['name'])
+    return Trainer.load(dct, loader)
+
+class TestBatch(QuietTestCase):
+    def battles(self, count=6):
+        return [(index, unseeded_description()) for index in range(count)]
+
+    def test_outcome(self):
+        outcome = batch.run_battle('x', battle_description)
+        assert outcome['error'] is None
+        assert outcome['ended']
+        assert outcome['winner'] in (0, 1)
+        assert outcome['turns'] > 0
+
+    def test_deterministic(self):
+        first = without_durations(batch.run_batch(self.battles(), 1))
+        second = without_durations(batch.run_batch(self.battles(), 1))
+        assert first == second
+        assert len(set(o['turns'] for o in first)) > 1
+        other_seed = without_durations(
+                batch.run_batch(self.battles(), 1, base_seed=1))
+        assert other_seed != first
+
+    def test_pool(self):
+        inline = without_durations(batch.run_batch(self.battles(), 1))
+        pooled = without_durations(batch.run_batch(self.battles(), 2))
+        assert pooled == inline
+
+    def test_error(self):
+        battles = self.battles(2) + [('broken', {'trainers': {}})]
+        outcomes = without_durations(batch.run_batch(battles, 2))
+        assert [o['error'] is None for o in outcomes] == [True, True, False]
+        assert 'Traceback' in outcomes[2]['error']
+        assert not outcomes[2]['ended']
+
+    def test_seed_description(self):
+        description = batch.seed_description(unseeded_description(), 'x')
+        assert description['seed'] == batch.derive_seed(0, 'x', 'field')
+        assert description['trainers'][0]['seed'] != (
+                description['trainers'][1]['seed'])
+        seeded = batch.seed_description(battle_description, 'x')
+        assert seeded == battle_description
+        overridden = batch.seed_description(battle_description, 'x',
+                override=True)
+        assert overridden == description
+
+    def test_observers(self):
+        received = []
+        outcome = batch.run_battle('x', battle_description,
+                observers=[received.append])
+        assert received[-1].side == outcome['winner']
+
+    def test_loaders(self):
+        default = without_durations(batch.run_batch(self.battles(), 2))
+        strong = without_durations(batch.run_batch(self.battles(), 2,
+                loader=strong_loader))
+        assert [o['error'] for o in strong] == [None] * 6
+        assert (sum(o['turns'] for o in strong) <
+                sum(o['turns'] for o in default))
+        del loaded_trainer_names[:]
+        outcomes = list(batch.run_batch(self.battles(1), 1,
+                trainer_loader=recording_trainer_loader))
+        assert outcomes[0]['error'] is None
+        assert sorted(loaded_trainer_names) == ['Blue', 'Red']
+
+    def test_import_object(self):
+        assert batch.import_object(
+                'regeneration.battle.trainer:Trainer') is Trainer
+        with pytest.raises(ValueError):
+            batch.import_object('regeneration.battle.trainer.Trainer')
@@ -0,0 +1,121 @@
+#! /usr/bin/env python
+# Encoding: UTF-8
+
+import json
+import time
+import copy
+from StringIO import StringIO
+
+import pytest
+
+from regeneration.battle.test import QuietTestCase
+from regeneration.battle.test.test_field import make_field
+
+from regeneration.battle import binlog
+
+__copyright__ = 'Copyright 2011, Petr Viktorin'
+__license__ = 'MIT'
+__email__ = 'encukou@gmail.com'
+
+class TestBinaryLog(QuietTestCase):
+    def run_logged(self, trainer_number=None):
+        field = make_field()
+        if trainer_number is None:
+            trainer = None
+        else:
+            trainer = field.sides[trainer_number].spots[0].trainer
+        stream = StringIO()
+        received = []
+        field.add_observer(received.append)
+        field.add_observer(binlog.BinaryLogWriter(stream, trainer))
+        field.run()
+        expected = [message.contents(trainer) for message in received]
+        return stream.getvalue(), expected
+
+    def test_roundtrip(self):
+        data, expected = self.run_logged()
+        assert binlog.loads(data) == expected
+
+    def test_roundtrip_private(self):
+        data, expected = self.run_logged(0)
+        assert binlog.loads(data) == expected
+
+    def test_small_chunks(self):
+        data, expected = self.run_logged()
+        decoded = list(binlog.read_log(StringIO(data), chunk_size=3))
+        assert decoded == expected
+
+    def test_size(self):
+        data, expected = self.run_logged()
+        assert len(data) * 10 < len(json.dumps(expected))
+
+    def test_values(self):
+        values = [None, True, False, 0, 1, -1, 63, 64, -2 ** 70, 2 ** 40,
+                2 ** 40, 0.5, 'abc', u'abc', u'žluv', 'abc',
+                {'a': 1}, {'a': 1}, {'a': {'b': u'c'}}, {'a': {'b': u'c'}},
+                {'b': u'c'}, {}]
+        encoder = binlog.Encoder()
+        decoder = binlog.Decoder()
+        for value in values:
+            data = bytearray()
+            encoder.encode_value(value, data)
+            decoded, pos = decoder.decode_value(data, 0)
+            assert pos == len(data)
+            assert decoded == value
+            assert type(decoded) == type(value)
+
+    def test_memo_types(self):
+        # Equal dicts whose values have different types aren't confused
+        values = [{'a': 1}, {'a': True}, {'a': 1.0}, {'a': 'x'}, {'a': u'x'},
+                {'b': {'a': 1}}, {'b': {'a': True}}]
+        encoder = binlog.Encoder()
+        decoder = binlog.Decoder()
+        for value in values + values:
+            data = bytearray()
+            encoder.encode_value(value, data)
+            decoded, pos = decoder.decode_value(data, 0)
+            assert repr(decoded) == repr(value)
+
+    def test_memo_lookup(self):
+        data, expected = self.run_logged()
+        encoder = CountingEncoder()
+        for contents in expected:
+            encoder.encode(contents)
+        first_count = encoder.count
+        for contents in copy.deepcopy(expected):
+            encoder.encode(contents)
+        # Equal dicts aren't encoded again, only their arguments are looked at
+        argument_count = sum(len(contents) - 1 for contents in expected)
+        assert encoder.count - first_count == argument_count
+        for contents in expected:
+            encoder.encode(contents)
+        assert encoder.count - first_count == argument_count * 2
+
+    def test_throughput(self):
+        data, expected = self.run_logged()
+        encoder = binlog.Encoder()
+        for contents in expected:
+            encoder.encode(contents)
+        copies = [copy.deepcopy(expected) for i in range(20)]
+        start = time.clock()
+        for contents_list in copies:
+            for contents in contents_list:
+                encoder.encode(contents)
+        rate = len(expected) * len(copies) / (time.clock() - start)
+        assert rate > 20000, '%d messages per second' % rate
+
+    def test_truncated(self):
+        data, expected = self.run_logged()
+        with pytest.raises(ValueError):
+            list(binlog.read_log(StringIO(data[:-1])))
+
+    def test_bad_magic(self):
+        with pytest.raises(ValueError):
+            list(binlog.read_log(StringIO('not a log')))
+
+class CountingEncoder(binlog.Encoder):
+    count = 0
+
+    def encode_value(self, value, out):
+        self.count += 1
+        return super(CountingEncoder, self).encode_value(value, out)
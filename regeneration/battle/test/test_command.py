@@ -24,6 +24,9 @@ class FakeField(object):
     def command_selected(self, command):
         self.selected_commands.append(command)
 
+    def record_setattr(self, obj, name):
+        pass
+
     struggle = loader.load_struggle()
     battlers = ['none']
 
@@ -3,10 +3,13 @@
 
 from itertools import chain, izip_longest
 
+import pytest
+
 from regeneration.battle.example import loader
 from regeneration.battle.test import QuietTestCase
 
 from regeneration.battle import effect
+from regeneration.battle.orderkey import OrderKeys
 
 __copyright__ = 'Copyright 2011, Petr Viktorin'
 __license__ = 'MIT'
@@ -52,6 +55,39 @@ class CountingEffect(BaseTestEffect):
     def count(self, subject, value):
         return value + 1
 
+class DisablingEffect(BaseTestEffect):
+    def disable_callback(self, effect, callback_name, arguments):
+        return callback_name == 'count'
+
+class UniqueEffect(BaseTestEffect):
+    pass
+
+UniqueEffect.unique_class = UniqueEffect
+
+class SubUniqueEffect(UniqueEffect):
+    pass
+
+test_order_keys = first_key, second_key = OrderKeys(2)
+
+class FirstCountingEffect(BaseTestEffect):
+    @effect.Effect.orderkey(first_key)
+    def count(self, subject, value):
+        return value + 1
+
+class SecondCountingEffect(BaseTestEffect):
+    @effect.Effect.orderkey(second_key)
+    def count(self, subject, value):
+        return value * 10
+
+class RemovingEffect(BaseTestEffect):
+    def __init__(self, victim):
+        self.victim = victim
+
+    @effect.Effect.orderkey(first_key)
+    def count(self, subject, value):
+        self.victim.remove()
+        return value + 1
+
 class TestEffect(QuietTestCase):
     def setup_method(self, m):
         super(TestEffect, self).setup_method(m)
@@ -194,3 +230,191 @@ class TestEffect(QuietTestCase):
         assert BaseTestEffect.count(self.subject_a, 0) == 1
         self.subject_b.give_effect_self(CountingEffect())
         assert BaseTestEffect.count(self.subject_a, 0) == 2
+
+    def test_dispatch_cache_invalidation(self):
+        field = self.fake_field
+        assert BaseTestEffect.count(field, 0) == 0
+        eff_a = field.give_effect_self(CountingEffect())
+        assert BaseTestEffect.count(field, 0) == 1
+        eff_b = field.give_effect_self(CountingEffect())
+        assert BaseTestEffect.count(field, 0) == 2
+        eff_a.remove()
+        assert BaseTestEffect.count(field, 0) == 1
+        with eff_b.disabled():
+            assert BaseTestEffect.count(field, 0) == 0
+        assert BaseTestEffect.count(field, 0) == 1
+
+    def test_dispatch_order(self):
+        field = self.fake_field
+        field.give_effect_self(SecondCountingEffect())
+        field.give_effect_self(FirstCountingEffect())
+        assert BaseTestEffect.count(field, 0) == 10
+        assert BaseTestEffect.count(field, 0) == 10
+
+    def test_removal_during_dispatch(self):
+        field = self.fake_field
+        victim = field.give_effect_self(SecondCountingEffect())
+        field.give_effect_self(RemovingEffect(victim))
+        assert BaseTestEffect.count(field, 0) == 1
+
+    def test_implemented_callbacks(self):
+        assert effect.Effect.implemented_callbacks == frozenset()
+        assert BaseTestEffect.implemented_callbacks == frozenset()
+        assert 'count' in BaseTestEffect.declared_callbacks
+        assert 'prevent_hit' in BaseTestEffect.declared_callbacks
+        assert CountingEffect.implemented_callbacks == set(['count'])
+        assert RecordingEffect.implemented_callbacks == set(['append'])
+        assert BlockingEffect.implemented_callbacks == set([
+                'block_application'])
+
+    def test_instance_callback(self):
+        field = self.fake_field
+        eff = effect.Effect()
+        eff.prevent_hit = lambda hit: 'prevented'
+        field.give_effect_self(eff)
+        assert effect.Effect.prevent_hit(field) == 'prevented'
+        eff.remove()
+        assert effect.Effect.prevent_hit(field) is None
+
+    def test_class_callback_change(self):
+        class LateEffect(BaseTestEffect):
+            pass
+        with pytest.raises(TypeError):
+            LateEffect.count = lambda self, field, value: value + 1
+        with pytest.raises(TypeError):
+            CountingEffect.count = lambda self, field, value: value + 1
+        with pytest.raises(TypeError):
+            del CountingEffect.count
+        with pytest.raises(TypeError):
+            LateEffect.disable_callback = lambda self, *args: True
+        with pytest.raises(TypeError):
+            LateEffect.late = effect.callback(lambda self, field: None)
+        assert LateEffect.implemented_callbacks == frozenset()
+        LateEffect.unique_class = LateEffect
+
+    def test_unimplemented_callback(self):
+        field = self.fake_field
+        field.give_effect_self(CountingEffect())
+        def fail(*args):
+            raise AssertionError('Effects probed for an unused callback')
+        field.get_effect_methods = fail
+        assert effect.Effect.ensure_hit(field) is None
+        assert effect.Effect.modify_accuracy(field, 3) == 3
+        assert BaseTestEffect.append(field, 1) == []
+
+    def test_disable_callback(self):
+        field = self.fake_field
+        field.give_effect_self(CountingEffect())
+        assert not CountingEffect.disables_callbacks
+        assert DisablingEffect.disables_callbacks
+        disabler = field.give_effect_self(DisablingEffect())
+        assert field._disablers == [disabler]
+        assert BaseTestEffect.count(field, 0) == 0
+        with disabler.disabled():
+            assert BaseTestEffect.count(field, 0) == 1
+        assert BaseTestEffect.count(field, 0) == 0
+        disabler.remove()
+        assert field._disablers == []
+        assert BaseTestEffect.count(field, 0) == 1
+
+    def test_effect_list(self):
+        effects = [effect.Effect() for i in range(5)]
+        effect_list = effect.EffectList(effects[:4])
+        assert list(effect_list) == effects[:4]
+        assert len(effect_list) == 4
+        effect_list.remove(effects[1])
+        assert effects[1] not in effect_list
+        assert effects[2] in effect_list
+        assert list(effect_list) == [effects[0], effects[2], effects[3]]
+        effect_list.remove(effects[3])
+        effect_list.append(effects[4])
+        assert list(effect_list) == [effects[0], effects[2], effects[4]]
+
+    def test_effect_list_changes_during_iteration(self):
+        effects = [effect.Effect() for i in range(5)]
+        effect_list = effect.EffectList(effects[:4])
+        seen = []
+        for eff in effect_list:
+            seen.append(eff)
+            if eff is effects[0]:
+                effect_list.remove(effects[0])
+                effect_list.remove(effects[1])
+                effect_list.append(effects[4])
+            if eff is effects[2]:
+                effect_list.remove(effects[3])
+        assert seen == [effects[0], effects[2]]
+        assert list(effect_list) == [effects[2], effects[4]]
+
+    def test_effect_list_tail_removed_during_iteration(self):
+        effects = [effect.Effect() for i in range(3)]
+        effect_list = effect.EffectList(effects[:2])
+        seen = []
+        for eff in effect_list:
+            seen.append(eff)
+            if eff is effects[0]:
+                effect_list.remove(effects[1])
+                effect_list.append(effects[2])
+        assert seen == [effects[0]]
+        assert list(effect_list) == [effects[0], effects[2]]
+
+    def test_get_effects_subclass(self):
+        eff_a = self.subject_a.give_effect_self(CountingEffect())
+        eff_b = self.subject_a.give_effect_self(RecordingEffect())
+        eff_c = self.subject_a.give_effect_self(CountingEffect())
+        assert list(self.subject_a.get_effects(CountingEffect)) == [
+                eff_a, eff_c]
+        assert list(self.subject_a.get_effects(BaseTestEffect)) == [
+                eff_a, eff_b, eff_c]
+        assert list(self.subject_a.get_effects(
+                (RecordingEffect, BlockingEffect))) == [eff_b]
+        eff_a.remove()
+        assert self.subject_a.get_effect(CountingEffect) is eff_c
+        with eff_c.disabled():
+            assert self.subject_a.get_effect(CountingEffect) is None
+        eff_c.reparent(self.subject_b)
+        assert self.subject_a.get_effect(CountingEffect) is None
+        assert self.subject_b.get_effect(BaseTestEffect) is eff_c
+
+    def test_unique_class(self):
+        eff = self.subject_a.give_effect_self(UniqueEffect())
+        assert eff is not None
+        assert self.subject_a.give_effect_self(UniqueEffect()) is None
+        assert self.subject_a.give_effect_self(SubUniqueEffect()) is None
+        assert self.subject_b.give_effect_self(SubUniqueEffect()) is not None
+        eff.remove()
+        assert self.subject_a.give_effect_self(UniqueEffect()) is not None
+
+    def test_active_effects_cache(self):
+        field = self.fake_field
+        eff_a = field.give_effect_self(effect.Effect())
+        active = field.active_effects
+        assert active == (eff_a, )
+        assert field.active_effects is active
+        eff_b = field.give_effect_self(effect.Effect())
+        assert field.active_effects == (eff_a, eff_b)
+        with eff_a.disabled():
+            assert field.active_effects == (eff_b, )
+        eff_b.remove()
+        assert field.active_effects == (eff_a, )
+
+    def test_chain_dispatcher(self):
+        field = self.fake_field
+        field.give_effect_self(SecondCountingEffect())
+        field.give_effect_self(FirstCountingEffect())
+        dispatcher = field.get_chain_dispatcher(BaseTestEffect, 'count')
+        assert dispatcher(field, 0) == 10
+        assert field.get_chain_dispatcher(BaseTestEffect, 'count') is (
+                dispatcher)
+        counting = field.give_effect_self(CountingEffect())
+        dispatcher = field.get_chain_dispatcher(BaseTestEffect, 'count')
+        # Effects without an order key go first: (0 + 1 + 1) * 10
+        assert dispatcher(field, 0) == 20
+        assert field.get_chain_dispatcher(RecordingEffect, 'count')(
+                field, 5) == 5
+
+    def test_chain_dispatcher_with_disabler(self):
+        field = self.fake_field
+        field.give_effect_self(CountingEffect())
+        field.give_effect_self(DisablingEffect())
+        assert field.get_chain_dispatcher(BaseTestEffect, 'count') is None
+        assert BaseTestEffect.count(field, 0) == 0
@@ -0,0 +1,469 @@
+#! /usr/bin/env python
+# Encoding: UTF-8
+
+import copy
+
+import pytest
+
+from regeneration.battle.example import loader
+from regeneration.battle.test import QuietTestCase
+
+from regeneration.battle import messages
+from regeneration.battle.effect import Effect, state_hash_key
+from regeneration.battle.field import Field
+from regeneration.battle.trainer import Trainer
+
+__copyright__ = 'Copyright 2011, Petr Viktorin'
+__license__ = 'MIT'
+__email__ = 'encukou@gmail.com'
+
+def make_monster(name, level, hp):
+    return dict(
+            level=level,
+            moves=[dict(kind='tackle', pp=10)],
+            nickname=name,
+            species='monster',
+            stats=dict(attack=100, defense=100, hp=hp, speed=level,
+                **{'special-attack': 100, 'special-defense': 100}),
+        )
+
+battle_description = dict(
+        battle_format=[[0], [1]],
+        seed=42,
+        trainers={
+                0: dict(name='Red', seed=1, team=[
+                        make_monster('Minion-1', 30, 80),
+                        make_monster('Minion-2', 40, 90),
+                    ]),
+                1: dict(name='Blue', seed=2, team=[
+                        make_monster('Minion-3', 35, 85),
+                        make_monster('Minion-4', 45, 70),
+                    ]),
+            },
+    )
+
+def make_field(**kwargs):
+    return Field.load(copy.deepcopy(battle_description), loader, **kwargs)
+
+def run_battle(observe=True):
+    field = make_field()
+    received = []
+    if observe:
+        field.add_observer(received.append)
+    field.run()
+    return field, received
+
+class CountingMessage(messages.Message):
+    registry_name = 'test_field.CountingMessage'
+    constructed = []
+
+    def __init__(self, field, **kwargs):
+        self.constructed.append(self)
+        super(CountingMessage, self).__init__(field, **kwargs)
+
+class DisablingTestEffect(Effect):
+    def prevent_move_selection(self, command):
+        return False
+
+class TestField(QuietTestCase):
+    def test_battle(self):
+        field, received = run_battle()
+        assert field.ended
+        assert isinstance(received[0], messages.BattleStart)
+        assert isinstance(received[-1], messages.BattleEnd)
+
+    def test_headless(self):
+        observed_field, received = run_battle()
+        field, nothing = run_battle(observe=False)
+        assert field.ended
+        assert field.turn_number == observed_field.turn_number
+        assert ([m.hp for m in field.sides[0].spots[0].trainer.team] ==
+            [m.hp for m in observed_field.sides[0].spots[0].trainer.team])
+
+    def test_headless_skips_construction(self):
+        field = make_field()
+        constructed = CountingMessage.constructed = []
+        field.message(CountingMessage)
+        assert constructed == []
+        received = []
+        field.add_observer(received.append)
+        field.message(CountingMessage)
+        assert received == constructed
+        assert len(received) == 1
+
+    def test_headless_checks_arguments(self):
+        field = make_field()
+        field.message.TurnStart(turn=1)
+        with pytest.raises(ValueError):
+            field.message.TurnStart(turn=1, tunr=2)
+        with pytest.raises(ValueError):
+            field.message.TurnStart()
+        field.message.Draw()
+        with pytest.raises(ValueError):
+            field.message.effectivity(hit=None, target=None)
+
+    def test_subscriptions(self):
+        field = make_field()
+        everything = []
+        ends = []
+        effectivities = []
+        turns = []
+        field.add_observer(everything.append)
+        field.add_observer(ends.append, messages.BattleEnd)
+        field.add_observer(effectivities.append, 'NormallyEffective')
+        field.add_observer(turns.append, [messages.TurnStart, 'TurnEnd'])
+        field.run()
+        assert ends == [m for m in everything
+                if isinstance(m, messages.BattleEnd)]
+        assert len(ends) == 1
+        assert effectivities == [m for m in everything
+                if isinstance(m, messages.NormallyEffective)]
+        assert effectivities
+        assert turns == [m for m in everything
+                if isinstance(m, (messages.TurnStart, messages.TurnEnd))]
+
+    def test_subscribe_unknown(self):
+        field = make_field()
+        with pytest.raises(ValueError):
+            field.add_observer(list().append, 'NoSuchMessage')
+        with pytest.raises(ValueError):
+            field.add_observer(list().append, [messages.TurnStart, None])
+        assert field.observers == []
+
+    def test_is_observed(self):
+        field = make_field()
+        field.add_observer(list().append, messages.SuperEffective)
+        assert field.is_observed(messages.SuperEffective)
+        assert not field.is_observed(messages.NotVeryEffective)
+        assert not field.is_observed(messages.EffectivityBase)
+        assert field.is_observed(messages.effectivity)
+        assert not field.is_observed(messages.TurnStart)
+        field.add_observer(list().append, messages.Message)
+        assert field.is_observed(messages.TurnStart)
+
+    def test_remove_observer(self):
+        field = make_field()
+        received = []
+        field.add_observer(received.append, messages.TurnStart)
+        field.remove_observer(received.append)
+        assert field.observers == []
+        assert not field.is_observed(messages.TurnStart)
+        field.run()
+        assert received == []
+
+    def test_serializers(self):
+        field, received = run_battle()
+        trainers = [None] + [spot.trainer for side in field.sides
+                for spot in side.spots]
+        for message in received:
+            for trainer in trainers:
+                expected = dict((name, messages.message_values(value,
+                        trainer)) for name, value in message.arguments.items())
+                expected['class'] = message.registry_name
+                assert message.contents(trainer, save=False) == expected
+
+    def test_visibility_groups(self):
+        field, received = run_battle()
+        red, blue = [side.spots[0].trainer for side in field.sides]
+        use_moves = [m for m in received if isinstance(m, messages.UseMove)]
+        assert use_moves
+        for message in use_moves:
+            public = message.contents()
+            assert public['moveeffect']['target'] is None
+            owner = message.arguments['battler'].trainer
+            other = blue if owner is red else red
+            assert message.contents(other) is public
+            owned = message.contents(owner)
+            assert owned is not public
+            assert owned['moveeffect']['target'] is not None
+            assert owned['battler'] is public['battler']
+
+    def test_message_view(self):
+        field, received = run_battle()
+        message = [m for m in received if isinstance(m, messages.UseMove)][0]
+        view = message.view
+        assert message.view is view
+        assert message.battler is view.battler
+        assert view.battler.spot is view.battler.spot
+        assert message['battler'] is view.battler
+        assert view.battler.name == message.contents()['battler']['name']
+        with pytest.raises(AttributeError):
+            view.battler = None
+        with pytest.raises(AttributeError):
+            view.nonexistent
+        assert unicode(message).endswith('used Tackle!')
+        view_copy = copy.copy(view)
+        assert view_copy.battler.name == view.battler.name
+        with pytest.raises(AttributeError):
+            view._private
+
+class ManualTrainer(Trainer):
+    """Trainer that leaves all requests pending"""
+    def request_command(self, request):
+        return None
+
+def make_manual_field():
+    return make_field(trainer_loader=ManualTrainer.load)
+
+def play(field, turns=None):
+    """Select the first allowed command for each request, for some turns"""
+    start = field.turn_number
+    while not field.ended and (turns is None or
+            field.turn_number - start < turns):
+        for battler, request in sorted(field.active_requests.items(),
+                key=lambda item: item[1].spot.side.number):
+            if battler in field.active_requests:
+                command = next(iter(request.commands()))
+                if command.command == 'move' and not command.target:
+                    command.target = command.possible_targets[0]
+                command.select()
+
+def battle_state(field):
+    return [(monster.hp, monster.status, [move.pp for move in monster.moves])
+            for side in field.sides for spot in side.spots
+            for monster in spot.trainer.team] + [
+                field.turn_number, field.state, field.rand.getstate()]
+
+class TestSnapshot(QuietTestCase):
+    def test_restore(self):
+        field = make_manual_field()
+        log = []
+        field.add_observer(lambda message: log.append(unicode(message)))
+        field.run()
+        play(field, 2)
+        snapshot = field.snapshot()
+        state = battle_state(field)
+        del log[:]
+        play(field)
+        assert field.ended
+        first_log = list(log)
+        final_state = battle_state(field)
+        for i in range(2):
+            field.restore(snapshot)
+            assert battle_state(field) == state
+            del log[:]
+            play(field)
+            assert log == first_log
+            assert battle_state(field) == final_state
+
+    def test_restore_effects(self):
+        field = make_manual_field()
+        field.run()
+        snapshot = field.snapshot()
+        battler = field.sides[0].spots[0].battler
+        effect = battler.give_effect_self(DisablingTestEffect())
+        battler.change_stat(field.loader.battle_stats[1], 2, verbose=False)
+        assert effect in battler.effects
+        assert field._callback_counts['prevent_move_selection']
+        field.restore(snapshot)
+        assert effect not in battler.effects
+        assert not list(battler.get_effects(DisablingTestEffect))
+        assert not field._callback_counts['prevent_move_selection']
+        assert battler.stat_levels[field.loader.battle_stats[1]] == 0
+        assert field.sides[0].spots[0].battler is battler
+
+    def test_restore_keeps_observers(self):
+        field = make_manual_field()
+        field.run()
+        snapshot = field.snapshot()
+        received = []
+        field.add_observer(received.append)
+        field.restore(snapshot)
+        play(field, 1)
+        assert received
+
+    def test_snapshot_skips_unsaved_attributes(self):
+        field = make_manual_field()
+        field.run()
+        snapshot = field.snapshot()
+        for obj, state in snapshot.states:
+            if obj is field:
+                for name in field.unsaved_attributes:
+                    assert name not in state
+
+class TestJournal(QuietTestCase):
+    def test_rollback(self):
+        field = make_manual_field()
+        log = []
+        field.add_observer(lambda message: log.append(unicode(message)))
+        field.run()
+        play(field, 2)
+        state = battle_state(field)
+        mark = field.mark()
+        del log[:]
+        play(field, 3)
+        inner_state = battle_state(field)
+        inner_mark = field.mark()
+        play(field)
+        assert field.ended
+        first_log = list(log)
+        final_state = battle_state(field)
+        field.rollback(inner_mark)
+        assert battle_state(field) == inner_state
+        field.rollback(mark)
+        assert battle_state(field) == state
+        assert field.journal == []
+        del log[:]
+        play(field)
+        assert log == first_log
+        assert battle_state(field) == final_state
+
+    def test_rollback_into_turn(self):
+        field = make_manual_field()
+        field.run()
+        marks = []
+        field.add_observer(lambda message: marks.append(field.mark()),
+                messages.TurnStart)
+        play(field, 1)
+        assert field.can_save
+        field.rollback(marks[0])
+        assert not field.can_save
+
+    def test_rollback_effects(self):
+        field = make_manual_field()
+        field.run()
+        battler = field.sides[0].spots[0].battler
+        first = battler.give_effect_self(DisablingTestEffect())
+        second = battler.give_effect_self(DisablingTestEffect())
+        order = list(battler.effects)
+        mark = field.mark()
+        first.remove()
+        third = battler.give_effect_self(DisablingTestEffect())
+        second.reparent(field)
+        assert list(battler.effects) == [e for e in order if e is not first
+                and e is not second] + [third]
+        field.rollback(mark)
+        assert list(battler.effects) == order
+        assert list(battler.get_effects(DisablingTestEffect)) == [
+                first, second]
+        assert first.active and first.subject is battler
+        assert field._callback_counts['prevent_move_selection'] == 2
+        field.stop_journal()
+        first.remove()
+        assert field.journal is None
+
+class TestStateHash(QuietTestCase):
+    def test_incremental(self):
+        field = make_field()
+        hashes = set()
+
+        def check(message):
+            assert field.state_hash == field.compute_state_hash()
+            hashes.add(field.state_hash)
+
+        field.add_observer(check)
+        field.run()
+        assert field.state_hash == field.compute_state_hash()
+        assert len(hashes) > 20
+
+    def test_same_state(self):
+        field = make_manual_field()
+        other = make_manual_field()
+        field.run()
+        other.run()
+        assert field.state_hash == other.state_hash
+        play(field, 1)
+        assert field.state_hash != other.state_hash
+        play(other, 1)
+        assert field.state_hash == other.state_hash
+
+    def test_effects(self):
+        field = make_manual_field()
+        field.run()
+        battler = field.sides[0].spots[0].battler
+        initial = field.state_hash
+        first = battler.give_effect_self(DisablingTestEffect())
+        with_one = field.state_hash
+        second = battler.give_effect_self(DisablingTestEffect())
+        assert len(set([initial, with_one, field.state_hash])) == 3
+        first.reparent(field.sides[0])
+        assert field.state_hash == field.compute_state_hash()
+        first.remove()
+        assert field.state_hash == with_one
+        second.remove()
+        assert field.state_hash == initial
+
+    def test_effects_of_withdrawn_battler(self):
+        field = make_manual_field()
+        field.run()
+        spot = field.sides[0].spots[0]
+        battler = spot.battler
+        effect = battler.give_effect_self(DisablingTestEffect())
+        other = battler.give_effect_self(DisablingTestEffect())
+        mark = field.mark()
+        field.switch(spot, spot.trainer.team[1])
+        switched = field.state_hash
+        assert switched == field.compute_state_hash()
+        effect.remove()
+        other.reparent(field.sides[0])
+        assert field.state_hash == field.compute_state_hash()
+        assert field.state_hash != switched
+        field.rollback(mark)
+        assert battler.in_state
+        assert field.state_hash == field.compute_state_hash()
+
+    def test_text_keys(self):
+        assert (state_hash_key(('name', u'Pok\xe9mon')) ==
+                state_hash_key(('name', 'Pok\xc3\xa9mon')))
+        assert (state_hash_key(('id', (u'caf\xe9', 1))) ==
+                state_hash_key(('id', ('caf\xc3\xa9', 1))))
+
+    def test_rollback_and_restore(self):
+        field = make_manual_field()
+        field.run()
+        snapshot = field.snapshot()
+        mark = field.mark()
+        initial = field.state_hash
+        play(field, 3)
+        field.rollback(mark)
+        assert field.state_hash == initial == field.compute_state_hash()
+        play(field, 3)
+        with pytest.raises(AssertionError):
+            field.restore(snapshot)
+        field.stop_journal()
+        field.restore(snapshot)
+        assert field.state_hash == initial == field.compute_state_hash()
+
+class TestSimulation(QuietTestCase):
+    def test_simulation(self):
+        field = make_manual_field()
+        log = []
+        field.add_observer(lambda message: log.append(unicode(message)))
+        field.run()
+        play(field, 1)
+        state = battle_state(field)
+        state_hash = field.state_hash
+        asked = []
+        for spot in field.spots:
+            spot.trainer.request_command = asked.append
+        del log[:]
+        with field.simulation():
+            assert field.simulating
+            play(field, 2)
+            assert battle_state(field) != state
+        assert not log
+        assert not asked
+        assert not field.simulating
+        assert field.journal is None
+        assert battle_state(field) == state
+        assert field.state_hash == state_hash
+        play(field, 1)
+        assert log
+        assert asked
+
+    def test_chance(self):
+        class AlwaysMiss(object):
+            def flip_coin(self, chance, blurb):
+                return False
+
+            def randint(self, min, max, blurb):
+                return min
+
+        field = make_manual_field()
+        field.run()
+        hp = [battler.hp for battler in field.battlers]
+        with field.simulation(AlwaysMiss()):
+            play(field, 2)
+            assert field.turn_number == 2
+            assert [battler.hp for battler in field.battlers] == hp
+        assert field.chance is None
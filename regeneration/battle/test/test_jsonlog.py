@@ -0,0 +1,80 @@
+#! /usr/bin/env python
+# Encoding: UTF-8
+
+import json
+from StringIO import StringIO
+
+import pytest
+
+from regeneration.battle.test import QuietTestCase
+from regeneration.battle.test.test_field import make_field
+
+from regeneration.battle import messages
+from regeneration.battle.jsonlog import JSONLogWriter
+
+__copyright__ = 'Copyright 2011, Petr Viktorin'
+__license__ = 'MIT'
+__email__ = 'encukou@gmail.com'
+
+class RecordingStream(StringIO):
+    def __init__(self):
+        StringIO.__init__(self)
+        self.writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        StringIO.write(self, data)
+
+class BrokenStream(object):
+    def write(self, data):
+        raise IOError('disk full')
+
+class TestJSONLogWriter(QuietTestCase):
+    def run_logged(self, **kwargs):
+        field = make_field()
+        red = field.sides[0].spots[0].trainer
+        public = RecordingStream()
+        private = RecordingStream()
+        received = []
+        field.add_observer(received.append)
+        writer = JSONLogWriter({None: public, red: private}, **kwargs)
+        field.add_observer(writer)
+        field.run()
+        writer.close()
+        for trainer, stream in (None, public), (red, private):
+            lines = stream.getvalue().splitlines()
+            assert [json.loads(line) for line in lines] == [
+                    json.loads(json.dumps(message.contents(trainer)))
+                    for message in received]
+        return received, public
+
+    def test_log(self):
+        received, stream = self.run_logged()
+        turn_ends = [m for m in received if isinstance(m, messages.TurnEnd)]
+        assert stream.writes == len(turn_ends) + 1
+
+    def test_flush_size(self):
+        received, stream = self.run_logged(flush_size=1)
+        assert stream.writes == len(received)
+
+    def test_background(self):
+        self.run_logged(background=True)
+
+    def test_background_error(self):
+        writer = JSONLogWriter({None: BrokenStream()}, background=True)
+        field = make_field()
+        field.add_observer(writer)
+        with pytest.raises(IOError):
+            # The error surfaces on a flush during the battle, or on close
+            field.run()
+            writer.close()
+
+    def test_context_manager(self):
+        stream = StringIO()
+        field = make_field()
+        with JSONLogWriter({None: stream}, flush_size=10 ** 6) as writer:
+            writer.flush_classes = ()
+            field.add_observer(writer)
+            field.run()
+            assert stream.getvalue() == ''
+        assert stream.getvalue().count('\n') > 1
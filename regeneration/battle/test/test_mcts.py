@@ -0,0 +1,172 @@
+#! /usr/bin/env python
+# Encoding: UTF-8
+
+import copy
+import time
+
+from regeneration.battle.example import loader
+from regeneration.battle.test import QuietTestCase
+from regeneration.battle.test.test_field import (make_manual_field, play,
+        battle_state, battle_description, make_monster)
+from regeneration.battle.test.test_search import make_search_field
+
+from regeneration.battle.field import Field
+from regeneration.battle.trainer import Trainer
+from regeneration.battle.mcts import MCTSTrainer, Node
+
+__copyright__ = 'Copyright 2011, Petr Viktorin'
+__license__ = 'MIT'
+__email__ = 'encukou@gmail.com'
+
+class SearchOnDemand(MCTSTrainer):
+    """Leaves requests pending; the tests call search() themselves"""
+    def request_command(self, request):
+        return None
+
+def count_wins(trainer_class, seeds, **kwargs):
+    """Count Red's wins against a random Trainer, one battle per seed"""
+    wins = 0
+    for seed in seeds:
+        description = copy.deepcopy(battle_description)
+        description['seed'] = seed
+        red, blue = description['trainers'][0], description['trainers'][1]
+        red['seed'] = seed * 2 + 1
+        red['team'].append(make_monster('Minion-5', 35, 60))
+        blue['seed'] = seed * 2 + 2
+        blue['team'].append(make_monster('Minion-6', 38, 75))
+
+        def load_trainer(dct, loader):
+            if dct['name'] == 'Red':
+                return trainer_class.load(dct, loader, **kwargs)
+            else:
+                return Trainer.load(dct, loader)
+
+        field = Field.load(description, loader, trainer_loader=load_trainer)
+        field.run()
+        if any(m.hp > 0 for m in field.sides[0].spots[0].trainer.team):
+            wins += 1
+    return wins
+
+class FakeClock(object):
+    """A clock that only moves when told to"""
+    def __init__(self):
+        self.time = 0
+
+    def __call__(self):
+        return self.time
+
+class SlowRollouts(SearchOnDemand):
+    """Each rollout takes a second of fake time"""
+    def __init__(self, *args, **kwargs):
+        super(SlowRollouts, self).__init__(*args, **kwargs)
+        self.clock = FakeClock()
+
+    def playout(self, field, rand):
+        self.clock.time += 1
+        return super(SlowRollouts, self).playout(field, rand)
+
+class LateWorkers(SearchOnDemand):
+    """Its worker processes don't report back in time"""
+    def _work(self, field, seed, deadline, connection):
+        time.sleep(10)
+
+class CountingSearch(SearchOnDemand):
+    """Records the number of rollouts done in the main process"""
+    def grow_tree(self, field, rand, deadline, track_changes=False):
+        result = super(CountingSearch, self).grow_tree(field, rand, deadline,
+                track_changes)
+        if not track_changes:
+            self.local_rollouts = result[0]
+        return result
+
+class TestNode(QuietTestCase):
+    def test_changes(self):
+        node = Node()
+        node.add(3, {(0, 'a'): [3, 2.0], (1, 'b'): [3, 1.0]})
+        old = node.copy()
+        node.add(2, {(0, 'a'): [1, 1.0], (0, 'c'): [1, 0.5],
+                (1, 'b'): [2, 0.5]})
+        visits, options = node.changes(old)
+        assert visits == 2
+        assert options == {(0, 'a'): [1, 1.0], (0, 'c'): [1, 0.5],
+                (1, 'b'): [2, 0.5]}
+        old.add(visits, options)
+        assert old.visits == node.visits == 5
+        assert old.options == node.options
+
+class TestMCTSTrainer(QuietTestCase):
+    def test_battle(self):
+        field = make_search_field(MCTSTrainer, time_limit=0.02, processes=1)
+        log = []
+        field.add_observer(lambda message: log.append(unicode(message)))
+        field.run()
+        red = field.sides[0].spots[0].trainer
+        assert red.last_stats['rollouts'] > 0
+        # The search left no trace
+        manual_field = make_manual_field()
+        manual_log = []
+        manual_field.add_observer(
+                lambda message: manual_log.append(unicode(message)))
+        manual_field.run()
+        assert log == manual_log
+        assert battle_state(field) == battle_state(manual_field)
+        command = field.commands[field.sides[0].spots[0].battler]
+        assert command.allowed
+        play(field)
+        assert field.ended
+        assert red.stats['decisions'] >= 1
+        assert red.rollouts_per_second() > 0
+        assert 'rollouts/s per process' in red.format_stats()
+
+    def test_beats_random(self):
+        seeds = range(10)
+        assert (count_wins(MCTSTrainer, seeds, time_limit=0.01, processes=1)
+                > count_wins(Trainer, seeds))
+
+    def test_time_limit(self):
+        field = make_search_field(SlowRollouts, time_limit=100, processes=1)
+        field.run()
+        red = field.sides[0].spots[0].trainer
+        for i in range(3):
+            red.search(field)
+            # The search didn't start a rollout it couldn't finish in time
+            assert red.last_stats['rollouts'] == 99
+            assert red.last_stats['duration'] == 99
+
+    def test_late_workers(self):
+        field = make_search_field(LateWorkers, time_limit=0.1, processes=3)
+        field.run()
+        red = field.sides[0].spots[0].trainer
+        red.search(field)
+        # The workers weren't waited for; only local rollouts were counted
+        assert red.last_stats['duration'] < 1
+        assert red.nodes[field.state_hash].visits == red.last_stats['rollouts']
+
+    def test_tree_reuse(self):
+        field = make_search_field(SearchOnDemand, time_limit=0.05,
+                processes=1)
+        field.run()
+        red = field.sides[0].spots[0].trainer
+        red.search(field)
+        assert red.last_stats['reused_visits'] == 0
+        visits = red.nodes[field.state_hash].visits
+        assert visits >= red.last_stats['rollouts'] > 0
+        red.search(field)
+        assert red.last_stats['reused_visits'] == visits
+
+    def test_processes(self):
+        # The workers stop at half time, to have plenty of time to report
+        field = make_search_field(CountingSearch, time_limit=0.5,
+                processes=3, reserve=0.5)
+        field.run()
+        state = battle_state(field)
+        red = field.sides[0].spots[0].trainer
+        commands = red.search(field)
+        assert [c.allowed for c in commands] == [True]
+        assert battle_state(field) == state
+        stats = red.last_stats
+        assert stats['processes'] == 3
+        # Both workers did rollouts, and they were merged into the tree (each
+        # rollout visits the starting position once)
+        assert stats['rollouts'] >= red.local_rollouts + 2
+        assert red.nodes[field.state_hash].visits == stats['rollouts']
@@ -0,0 +1,102 @@
+#! /usr/bin/env python
+# Encoding: UTF-8
+
+import threading
+
+import pytest
+
+from regeneration.battle.test import QuietTestCase
+from regeneration.battle.test.test_field import make_field, run_battle
+
+from regeneration.battle.observers import QueuedObserver
+
+__copyright__ = 'Copyright 2011, Petr Viktorin'
+__license__ = 'MIT'
+__email__ = 'encukou@gmail.com'
+
+class GatedObserver(object):
+    """Observer that blocks on its first message until released"""
+    def __init__(self):
+        self.received = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self, message):
+        self.started.set()
+        self.release.wait()
+        self.received.append(message)
+
+class TestQueuedObserver(QuietTestCase):
+    def run_gated(self, policy, **kwargs):
+        field, messages = run_battle()
+        observer = GatedObserver()
+        queued = QueuedObserver(observer, maxsize=2, policy=policy, **kwargs)
+        queued(messages[0])
+        observer.started.wait()
+        for message in messages[1:5]:
+            queued(message)
+        observer.release.set()
+        queued.close()
+        return messages, observer.received, queued.dropped
+
+    def test_battle(self):
+        field = make_field()
+        red = field.sides[0].spots[0].trainer
+        received = []
+        direct = []
+        queued = QueuedObserver(received.append, maxsize=3,
+                trainers=(None, red))
+        field.add_observer(direct.append)
+        field.add_observer(queued)
+        field.run()
+        queued.close()
+        assert received == direct
+        for message in received:
+            assert red in message._contents
+
+    def test_drop(self):
+        messages, received, dropped = self.run_gated('drop')
+        assert received == messages[:3]
+        assert dropped == 2
+
+    def test_drop_oldest(self):
+        messages, received, dropped = self.run_gated('drop_oldest')
+        assert received == [messages[0]] + messages[3:5]
+        assert dropped == 2
+
+    def test_coalesce(self):
+        # Key messages by the parity of their position
+        positions = {}
+        messages, received, dropped = self.run_gated('coalesce',
+                key=lambda m: positions.setdefault(id(m), len(positions)) % 2)
+        # Messages 1 and 2 were replaced by 3 and 4, in their places
+        assert received == [messages[0], messages[3], messages[4]]
+        assert dropped == 2
+
+    def test_coalesce_needs_key(self):
+        with pytest.raises(ValueError):
+            QueuedObserver(list().append, policy='coalesce')
+        with pytest.raises(ValueError):
+            QueuedObserver(list().append, key=id)
+
+    def test_block(self):
+        field, messages = run_battle()
+        received = []
+        with QueuedObserver(received.append, maxsize=1) as queued:
+            for message in messages:
+                queued(message)
+        assert received == messages
+        assert queued.dropped == 0
+
+    def test_error(self):
+        def observer(message):
+            raise ZeroDivisionError()
+        field, messages = run_battle()
+        queued = QueuedObserver(observer)
+        queued(messages[0])
+        with pytest.raises(ZeroDivisionError):
+            queued.close()
+
+    def test_bad_policy(self):
+        with pytest.raises(ValueError):
+            QueuedObserver(list().append, policy='ignore')
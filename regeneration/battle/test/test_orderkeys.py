@@ -1,7 +1,10 @@
 #! /usr/bin/env python
 # Encoding: UTF-8
 
+import random
+
 from regeneration.battle.test import QuietTestCase
+from regeneration.battle import orderkey
 from regeneration.battle.orderkey import OrderKeys
 
 __copyright__ = 'Copyright 2011, Petr Viktorin'
@@ -53,3 +56,61 @@ class TestOrderKeys(QuietTestCase):
         keys = k2, k3, k4 = OrderKeys(3)
         k1 = k2.new_before()
         self.check(keys, k1, k2, k3, k4)
+
+    def check_many(self, keys, expected):
+        assert list(keys) == expected
+        assert list(reversed(keys)) == expected[::-1]
+        for k1, k2 in zip(expected, expected[1:]):
+            assert k1 < k2
+            assert k1.rank < k2.rank
+            assert isinstance(k1.id, int)
+
+    def test_many_after(self):
+        keys = k1, k2 = OrderKeys(2)
+        added = [k1.new_after() for i in range(500)]
+        self.check_many(keys, [k1] + added[::-1] + [k2])
+
+    def test_many_before(self):
+        keys = k1, k2 = OrderKeys(2)
+        added = [k2.new_before() for i in range(500)]
+        self.check_many(keys, [k1] + added + [k2])
+
+    def test_many_random(self):
+        rand = random.Random(0)
+        keys = OrderKeys(3)
+        expected = list(keys)
+        for i in range(2000):
+            index = rand.randrange(len(expected))
+            if rand.random() < 0.5:
+                expected.insert(index, expected[index].new_before())
+            else:
+                expected.insert(index + 1, expected[index].new_after())
+        self.check_many(keys, expected)
+
+    def check_ranks(self, *sequences):
+        all_keys = [key for keys in sequences for key in keys]
+        for k1 in all_keys:
+            for k2 in all_keys:
+                assert cmp(k1.rank, k2.rank) == cmp(k1.id, k2.id)
+
+    def test_freeze(self):
+        keys = k1, k2, k4 = OrderKeys(3)
+        other_keys = OrderKeys(3)
+        other_keys.first.new_after()
+        orderkey.freeze()
+        assert k1.rank < k2.rank < k4.rank
+        k3 = k2.new_after()
+        self.check(keys, k1, k2, k3, k4)
+        k0 = keys.new_first()
+        assert k0.rank < k1.rank
+        self.check_ranks(keys, other_keys)
+        new_keys = OrderKeys(3)
+        self.check_ranks(keys, other_keys, new_keys)
+
+    def test_many_frozen(self):
+        orderkey.freeze()
+        keys = k1, k2 = OrderKeys(2)
+        added = [k1.new_after() for i in range(100)]
+        self.check_many(keys, [k1] + added[::-1] + [k2])
+        other_keys = OrderKeys(2)
+        self.check_ranks(keys, other_keys)
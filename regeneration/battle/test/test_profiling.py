@@ -0,0 +1,88 @@
+#! /usr/bin/env python
+# Encoding: UTF-8
+
+import json
+from StringIO import StringIO
+
+import pytest
+
+from regeneration.battle.test import QuietTestCase
+
+from regeneration.battle import effect
+from regeneration.battle.profiling import HookProfiler
+
+__copyright__ = 'Copyright 2011, Petr Viktorin'
+__license__ = 'MIT'
+__email__ = 'encukou@gmail.com'
+
+class CountingEffect(effect.Effect):
+    def modify_accuracy(self, subject, value):
+        return value + 1
+
+class PreventingEffect(effect.Effect):
+    def prevent_hit(self, hit):
+        return True
+
+class TestHookProfiler(QuietTestCase):
+    def setup_method(self, m):
+        super(TestHookProfiler, self).setup_method(m)
+        self.field = effect.EffectSubject(None)
+        self.field.field = self.field
+        self.field.give_effect_self(CountingEffect())
+        self.field.give_effect_self(CountingEffect())
+        self.field.give_effect_self(PreventingEffect())
+
+    def test_profiling(self):
+        profiler = HookProfiler()
+        with profiler:
+            assert effect.Effect.modify_accuracy(self.field, 0) == 2
+            assert effect.Effect.modify_accuracy(self.field, 0) == 2
+            assert effect.Effect.prevent_hit(self.field) is True
+            assert effect.Effect.ensure_hit(self.field) is None
+        results = profiler.as_dict()
+        assert results['modify_accuracy']['calls'] == 2
+        assert results['modify_accuracy']['listeners'] == 4
+        classes = results['modify_accuracy']['effect_classes']
+        assert classes.keys() == [
+                'regeneration.battle.test.test_profiling.CountingEffect']
+        assert classes.values()[0]['calls'] == 4
+        assert results['prevent_hit']['listeners'] == 1
+        assert results['ensure_hit']['calls'] == 1
+        assert results['ensure_hit']['listeners'] == 0
+        assert 'modify_move_damage' not in results
+
+    def test_instance_callback(self):
+        field = effect.EffectSubject(None)
+        field.field = field
+        instance_effect = effect.Effect()
+        instance_effect.prevent_hit = lambda hit: 'prevented'
+        field.give_effect_self(instance_effect)
+        profiler = HookProfiler()
+        with profiler:
+            assert effect.Effect.prevent_hit(field) == 'prevented'
+        classes = profiler.as_dict()['prevent_hit']['effect_classes']
+        assert classes['regeneration.battle.effect.Effect']['calls'] == 1
+
+    def test_disabled(self):
+        profiler = HookProfiler()
+        with profiler:
+            pass
+        assert effect.Effect.modify_accuracy(self.field, 0) == 2
+        assert profiler.as_dict() == {}
+        assert 'run_all' not in vars(effect.Effect.__dict__['prevent_hit'])
+
+    def test_single_profiler(self):
+        with HookProfiler():
+            with pytest.raises(RuntimeError):
+                HookProfiler().enable()
+
+    def test_output(self):
+        profiler = HookProfiler()
+        with profiler:
+            effect.Effect.modify_accuracy(self.field, 0)
+        stream = StringIO()
+        profiler.dump_json(stream)
+        assert json.loads(stream.getvalue()) == profiler.as_dict()
+        table = profiler.format_table()
+        assert 'modify_accuracy' in table
+        assert 'CountingEffect' in table
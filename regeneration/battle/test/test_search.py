@@ -0,0 +1,134 @@
+#! /usr/bin/env python
+# Encoding: UTF-8
+
+from fractions import Fraction
+
+from regeneration.battle.test import QuietTestCase
+from regeneration.battle.test.test_field import (make_field,
+        make_manual_field, ManualTrainer, play, battle_state)
+
+from regeneration.battle.search import ChanceScript, ExpectiminimaxTrainer
+
+__copyright__ = 'Copyright 2011, Petr Viktorin'
+__license__ = 'MIT'
+__email__ = 'encukou@gmail.com'
+
+def enumerate_outcomes(events, **kwargs):
+    outcomes = []
+    script = []
+    while script is not None:
+        chance = ChanceScript(script, **kwargs)
+        outcomes.append((events(chance), chance.probability))
+        script = chance.next_script()
+    return outcomes
+
+def coin_and_die(chance):
+    return (chance.flip_coin(Fraction(1, 4), 'Flip a coin'),
+            chance.randint(1, 6, 'Roll a die'))
+
+def make_search_field(trainer_class=ExpectiminimaxTrainer, **kwargs):
+    """Make a field where Red searches and Blue is a ManualTrainer"""
+    def load_trainer(dct, loader):
+        if dct['name'] == 'Red':
+            return trainer_class.load(dct, loader, **kwargs)
+        else:
+            return ManualTrainer.load(dct, loader)
+    return make_field(trainer_loader=load_trainer)
+
+class StepClock(object):
+    """A fake clock that advances by one second each time it's read"""
+    def __init__(self):
+        self.time = 0
+
+    def __call__(self):
+        self.time += 1
+        return self.time
+
+class TestChanceScript(QuietTestCase):
+    def test_outcomes(self):
+        outcomes = enumerate_outcomes(coin_and_die, bucket_count=3,
+                min_probability=0)
+        assert [outcome for outcome, probability in outcomes] == [
+                (True, 1), (True, 3), (True, 5),
+                (False, 1), (False, 3), (False, 5)]
+        assert [round(p * 12) for outcome, p in outcomes] == [1] * 3 + [3] * 3
+
+    def test_unlikely_outcomes(self):
+        outcomes = enumerate_outcomes(coin_and_die, bucket_count=3,
+                min_probability=0.2)
+        assert outcomes[0] == ((True, 1), 0.25)
+        assert [outcome for outcome, probability in outcomes[1:]] == [
+                (False, 1), (False, 3), (False, 5)]
+        outcomes = enumerate_outcomes(coin_and_die, min_probability=0.5)
+        assert outcomes == [((False, 1), 1.0)]
+
+    def test_certain(self):
+        chance = ChanceScript([])
+        assert chance.flip_coin(Fraction(1), 'Sure hit') is True
+        assert chance.flip_coin(Fraction(0), 'Sure miss') is False
+        assert chance.randint(4, 4, 'Only one') == 4
+        assert chance.next_script() is None
+
+class TestExpectiminimaxTrainer(QuietTestCase):
+    def test_battle(self):
+        field = make_search_field(max_depth=1, time_limit=10)
+        log = []
+        field.add_observer(lambda message: log.append(unicode(message)))
+        field.run()
+        red = field.sides[0].spots[0].trainer
+        assert red.last_depth == 1
+        # The search left no trace
+        manual_field = make_manual_field()
+        manual_log = []
+        manual_field.add_observer(
+                lambda message: manual_log.append(unicode(message)))
+        manual_field.run()
+        assert log == manual_log
+        assert battle_state(field) == battle_state(manual_field)
+        command = field.commands[field.sides[0].spots[0].battler]
+        assert command.allowed
+        # Switching would just give the opponent a free hit
+        assert command.command == 'move'
+        play(field)
+        assert field.ended
+
+    def test_heuristic(self):
+        def prefer_second(field, trainer):
+            return sum(1 for spot in field.spots
+                    if spot.battler.monster is trainer.team[1])
+
+        field = make_search_field(heuristic=prefer_second, max_depth=1,
+                time_limit=10)
+        field.run()
+        command = field.commands[field.sides[0].spots[0].battler]
+        assert command.command == 'switch'
+        assert command.replacement.name == 'Minion-2'
+
+    def test_time_limit(self):
+        field = make_search_field(time_limit=200, max_depth=50)
+        red = field.sides[0].spots[0].trainer
+        red.clock = StepClock()
+        field.run()
+        # The search stopped when the (fake) time ran out, and used the
+        # deepest search it completed
+        assert red.clock.time > 200
+        assert 1 <= red.last_depth < 50
+        command = field.commands[field.sides[0].spots[0].battler]
+        assert command.command == 'move'
+
+    def test_cache(self):
+        field = make_search_field(max_depth=2, time_limit=10)
+        field.run()
+        red = field.sides[0].spots[0].trainer
+        assert red.last_depth == 2
+        assert red.cache
+        for state_hash, depth in red.cache:
+            assert depth == 1
+        # Another battle in the same state can reuse the values
+        other_field = make_search_field(max_depth=2, time_limit=10)
+        other_red = other_field.sides[0].spots[0].trainer
+        other_red.cache = red.cache
+        other_field.run()
+        assert other_red.simulated_turns < red.simulated_turns
+        assert other_red.last_depth == 2
+        assert battle_state(other_field) == battle_state(field)